@@ -0,0 +1,227 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import openpyxl
+from openpyxl import Workbook
+
+import xlsx_parser
+from xlsx_parser import FingerprintCache, XLSXParser
+
+
+PERIODS = tuple(XLSXParser.PERIOD_TRANSFER)  # reference list of periods written to the second page
+UNITS = ('м2', 'м3', 'шт', 'кг', 'т', 'п.м.', 'компл.', 'услуга')  # reference list of units for the third page
+BAD_PERIODS = ('раз в сутки', 'Раз в месяц ', 'раз в месц', 'по мере необходимости')  # unknown and near-miss values
+BAD_UNITS = ('м²', 'Шт', 'штука', 'куб.м')
+BAD_NUMBERS = ('н/д', '-', 'см. примечание', '1.2.3')
+PHASES = ('lookup', 'load', 'fetch', 'numbers', 'references', 'price', 'cache', 'report', 'reload', 'save')  # timers
+# of XLSXParser: lookup of unchanged file in cache, load of the file with reference lists, reading of checked columns,
+# checks of numeric and reference columns, 'Годовая стоимость', cache of rows, report, full load of pre-scanned file to
+# fix it, save
+RUNS = ('first', 'rerun')  # check of generated file, check of the same file again after it was fixed
+KEYS = ('rows', 'columns', 'error_rate', 'engine', 'prescan', 'with_cache', 'run')  # parameters of a case
+
+
+def generate_workbook(path: str, rows: int = 1000, columns: int = 7, error_rate: float = 0.05, seed: int = 0):
+    """
+    Generates workbook shaped as an estimate: headers in row 4 (STARTING_ROW - 1), data from row 5, period and unit
+    reference lists on the second and the third pages. Checked cells contain errors with given probability: comma
+    decimals and bad numbers in numeric columns, unknown or near-miss periods and units
+    :param path: str
+    :param rows: int (number of data rows)
+    :param columns: int (number of data columns starting from column C, at least 7, the rest are notes)
+    :param error_rate: float (probability of error in every checked cell)
+    :param seed: int (seed of random generator)
+    :return:
+    """
+    rnd = random.Random(seed)
+    headers = ('Наименование', ) + XLSXParser.PERIOD_SUBSECTIONS + XLSXParser.UNIT_SUBSECTIONS + \
+        XLSXParser.NUM_SUBSECTIONS
+    headers += tuple('Примечание {}'.format(i) for i in range(1, max(columns, len(headers)) - len(headers) + 1))
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Смета')
+    for _ in range(XLSXParser.STARTING_ROW - 2):
+        ws.append([])
+    ws.append([None, None] + list(headers))
+
+    def number(value):
+        if rnd.random() >= error_rate:
+            return value
+        if rnd.random() < 0.5:
+            return str(value).replace('.', ',')  # comma decimal, should be fixed
+        return rnd.choice(BAD_NUMBERS)
+
+    for row in range(XLSXParser.STARTING_ROW, XLSXParser.STARTING_ROW + rows):
+        period = rnd.choice(BAD_PERIODS) if rnd.random() < error_rate else rnd.choice(PERIODS)
+        unit = rnd.choice(BAD_UNITS) if rnd.random() < error_rate else rnd.choice(UNITS)
+        values = ['Работа {}'.format(row), period, unit, number(rnd.randint(1, 4)),
+                  number(round(rnd.uniform(0.1, 5000), rnd.randint(0, 7))), number(round(rnd.uniform(1, 900), 2)),
+                  None]
+        values += ['примечание {}'.format(rnd.randint(1, 100)) for _ in range(len(headers) - len(values))]
+        ws.append([None, None] + values)
+    for title, values in (('Периодичность', PERIODS), ('Единицы измерения', UNITS)):
+        page = wb.create_sheet(title)
+        for value in values:
+            page.append([value])
+    wb.save(path)
+
+
+def run_case(path: str, engine: str = 'openpyxl', is_validator: bool = True, prescan: bool = False,
+             cache: bool = False, run: str = 'first') -> dict:
+    """
+    Runs XLSXParser pipeline on a copy of workbook as validate_file does (constructor and find_errors) and returns time
+    of its phases taken from timers of the parser: every phase is timed once and phases do not overlap, 'other' is the
+    rest of the run outside of them and 'total' is wall time of the run. Before the 'rerun' the copy is checked and
+    fixed once with the same options (the cache is filled by that run too)
+    :param path: str (generated workbook, it is not changed)
+    :param engine: str (save engine of XLSXParser)
+    :param is_validator: bool
+    :param prescan: bool (check the file in read-only mode first)
+    :param cache: bool (use FingerprintCache in a temporary directory)
+    :param run: str (one of RUNS)
+    :return: dict (phase -> seconds, number of changes)
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        work_path = os.path.join(tmp_dir, os.path.basename(path))
+        shutil.copy(path, work_path)
+        options = {'engine': engine, 'prescan': prescan,
+                   'cache': FingerprintCache(os.path.join(tmp_dir, 'cache')) if cache else None}
+        if run != 'first':
+            XLSXParser(work_path, is_validator, **options).find_errors()
+        start = time.perf_counter()
+        parser = XLSXParser(work_path, is_validator, **options)
+        parser.find_errors()
+        timings = {'total': time.perf_counter() - start}
+        timings.update((phase, parser.timers.get(phase, 0.0)) for phase in PHASES)
+        timings['other'] = timings['total'] - sum(timings[phase] for phase in PHASES)
+        timings['changes'] = len(parser.changes)
+        return timings
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def measure_memory(path: str, *args) -> int:
+    """
+    Returns peak memory (bytes allocated by python) of the whole pipeline, run separately as tracing slows it down
+    :param path: str
+    :param args: other arguments of run_case
+    :return: int
+    """
+    tracemalloc.start()
+    try:
+        run_case(path, *args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_matrix(rows: list, columns: list, error_rates: list, engines: list, prescans: tuple = (False, True),
+               caches: tuple = (False, True), runs: tuple = RUNS, repeat: int = 1, memory: bool = True) -> dict:
+    """
+    Runs benchmark for every combination of sizes, error rates, save engines, modes of check (prescan), use of cache
+    and kinds of run, the best time of repeats is kept
+    :param rows: list
+    :param columns: list
+    :param error_rates: list
+    :param engines: list
+    :param prescans: tuple
+    :param caches: tuple
+    :param runs: tuple
+    :param repeat: int
+    :param memory: bool (measure peak memory)
+    :return: dict (environment and list of results)
+    """
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for row_amount in rows:
+            for col_amount in columns:
+                for error_rate in error_rates:
+                    path = os.path.join(tmp_dir, 'bench_{}_{}_{}.xlsx'.format(row_amount, col_amount, error_rate))
+                    generate_workbook(path, row_amount, col_amount, error_rate)
+                    for args in itertools.product(engines, prescans, caches, runs):
+                        timings = [run_case(path, args[0], True, *args[1:]) for _ in range(repeat)]
+                        case = dict(zip(KEYS, (row_amount, col_amount, error_rate) + args))
+                        case.update({'file_size': os.path.getsize(path), 'changes': timings[0]['changes']})
+                        case.update({phase: min(timing[phase] for timing in timings)
+                                     for phase in PHASES + ('other', 'total')})
+                        if memory:
+                            case['peak_memory'] = measure_memory(path, args[0], True, *args[1:])
+                        results.append(case)
+                        print(json.dumps(case), file=sys.stderr)  # progress
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {'environment': {'python': platform.python_version(), 'openpyxl': openpyxl.__version__,
+                            'numpy': xlsx_parser.get_numpy() is not None, 'machine': platform.machine(),
+                            'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+def compare(old: dict, new: dict) -> list:
+    """
+    Compares two benchmark outputs and returns ratios new/old of time of phases and peak memory for equal cases,
+    cases of results written before prescan, cache and run were added to the matrix are taken as first runs of full
+    load without cache
+    :param old: dict
+    :param new: dict
+    :return: list
+    """
+    defaults = {'prescan': False, 'with_cache': False, 'run': 'first'}
+
+    def key(case):
+        return tuple(case.get(name, defaults.get(name)) for name in KEYS)
+    old_cases = {key(case): case for case in old['results']}
+    ans = []
+    for case in new['results']:
+        if key(case) in old_cases:
+            before = old_cases[key(case)]
+            row = dict(zip(KEYS, key(case)))
+            for metric in PHASES + ('other', 'total', 'peak_memory'):
+                if before.get(metric) and case.get(metric) is not None:
+                    row[metric] = round(case[metric] / before[metric], 3)
+            ans.append(row)
+    return ans
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark of XLSXParser pipeline on generated estimates')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--columns', type=int, nargs='+', default=[7, 40])
+    parser.add_argument('--error-rate', type=float, nargs='+', default=[0.05])
+    parser.add_argument('--engine', nargs='+', default=list(XLSXParser.ENGINES), choices=XLSXParser.ENGINES)
+    parser.add_argument('--prescan', type=int, nargs='+', default=[0, 1], choices=(0, 1),
+                        help='0 - full load, 1 - check in read-only mode first')
+    parser.add_argument('--cache', type=int, nargs='+', default=[0, 1], choices=(0, 1),
+                        help='0 - without cache, 1 - with cache of fingerprints')
+    parser.add_argument('--run', nargs='+', default=list(RUNS), choices=RUNS,
+                        help='first - check of generated file, rerun - check of the fixed file again')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory')
+    parser.add_argument('--output', help='file to write JSON results to (stdout by default)')
+    parser.add_argument('--compare', help='previous JSON results to compare with')
+    args = parser.parse_args(argv)
+    results = run_matrix(args.rows, args.columns, args.error_rate, args.engine, tuple(map(bool, args.prescan)),
+                         tuple(map(bool, args.cache)), tuple(args.run), args.repeat, not args.no_memory)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            results['comparison'] = compare(json.load(f), results)
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,500 @@
+import csv
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import zipfile
+
+import pytest
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font, PatternFill
+
+import xlsx_parser
+from xlsx_parser import (EXPORT_FIELDS, ChangeSet, FingerprintCache, XLSXParser, enable_console, get_sheet_paths,
+                         normalize_num_column, read_data_validations, validate_batch, validate_file)
+
+PERIODS = ('раз в день', 'раз в месяц', 'раз в год')
+UNITS = ('м2', 'шт', 'кг')
+HEADERS = ('Наименование', 'Периодичность', 'Ед.изм.', 'Раз', 'Объем', 'Расценка', 'Годовая стоимость')
+ROWS = (('работа 1', 'раз в день', 'шт', 1, '2,5', 100, None),
+        ('работа 2', 'каждый день', 'кг', '1,5', 2, 'abc', None),
+        ('работа 3', 'раз в месяц', 'м²', 'x', 10.123456789, '7,25', None),
+        ('работа 4', 'раз в год', 'м2', 2, 5, 100, '=F8*1*G8*H8/1000'))
+CALC_CHAIN = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+              '<calcChain xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+              '<c r="I8" i="1"/></calcChain>')
+EXPORTED = (('Смета', 5, 0, 1.0, 2.5, 100.0, 'раз в день', 365.0, 'шт', 91.25, False, False, False),
+            ('Смета', 6, 0, 1.5, 2.0, None, 'каждый день', None, 'кг', None, True, True, False),
+            ('Смета', 7, 0, None, 10.12346, 7.25, 'раз в месяц', 12.0, 'м²', None, True, False, True),
+            ('Смета', 8, 0, 2.0, 5.0, 100.0, 'раз в год', 1.0, 'м2', 1.0, False, False, False))  # cleaned ROWS
+
+
+def make_workbook(path, rows=ROWS, units=UNITS):
+    """
+    Writes estimate sheet with given data rows (from row 5) and reference pages of periods and units
+    """
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Смета'
+    for title, values in (('Периоды', PERIODS), ('Единицы', units)):
+        sheet = wb.create_sheet(title)
+        for row, value in enumerate(values, 1):
+            sheet.cell(row, 1, value)
+    for col_num, header in enumerate(HEADERS, 3):
+        ws.cell(4, col_num, header)
+    for row, values in enumerate(rows, 5):
+        for col_num, value in enumerate(values, 3):
+            if value is not None:
+                ws.cell(row, col_num, value)
+    for row in range(5, 5 + len(rows)):
+        ws.cell(row, 9).font = Font(bold=True)  # empty styled cells are written as self-closing <c/>
+    wb.save(path)
+    use_shared_strings(path)
+    return str(path)
+
+
+def add_sheet_copies(path, count):
+    """
+    Appends copies of the estimate sheet after the reference pages, titled 'Смета 2', 'Смета 3' and so on
+    """
+    wb = load_workbook(path)
+    for number in range(2, count + 2):
+        wb.copy_worksheet(wb.worksheets[0]).title = 'Смета {}'.format(number)
+    wb.save(path)
+    return path
+
+
+def rewrite_part(path, name, function):
+    """
+    Replaces part of .xlsx archive with function(old content)
+    """
+    with zipfile.ZipFile(path) as archive:
+        parts = [(info, archive.read(info)) for info in archive.infolist()]
+    names = [info.filename for info, content in parts]
+    if name not in names:
+        parts.append((zipfile.ZipInfo(name), b''))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for info, content in parts:
+            if info.filename == name:
+                content = function(content.decode('utf-8')).encode('utf-8')
+            archive.writestr(info, content)
+
+
+def use_shared_strings(path):
+    """
+    Moves inline strings of the first sheet to shared strings part, as Excel writes them
+    """
+    strings = []
+
+    def share(match):
+        strings.append(match.group(2))
+        return '<c{} t="s"><v>{}</v></c>'.format(match.group(1), len(strings) - 1)
+    rewrite_part(path, 'xl/worksheets/sheet1.xml', lambda xml: re.sub(
+        r'<c([^>]*?) t="inlineStr"><is><t>(.*?)</t></is></c>', share, xml))
+    rewrite_part(path, 'xl/sharedStrings.xml', lambda xml: (
+        '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" count="{0}" uniqueCount="{0}">{1}'
+        '</sst>'.format(len(strings), ''.join('<si><t>{}</t></si>'.format(string) for string in strings))))
+    rewrite_part(path, 'xl/_rels/workbook.xml.rels', lambda xml: xml.replace(
+        '</Relationships>', '<Relationship Id="rIdStrings" Target="sharedStrings.xml" Type="http://schemas.'
+                            'openxmlformats.org/officeDocument/2006/relationships/sharedStrings"/></Relationships>'))
+    rewrite_part(path, '[Content_Types].xml', lambda xml: xml.replace(
+        '</Types>', '<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-'
+                    'officedocument.spreadsheetml.sharedStrings+xml"/></Types>'))
+
+
+def sheet_xml(path, sheet=0):
+    with zipfile.ZipFile(path) as archive:
+        return archive.read(get_sheet_paths(archive)[sheet]).decode('utf-8')
+
+
+def add_calc_chain(path):
+    rewrite_part(path, 'xl/calcChain.xml', lambda xml: CALC_CHAIN)
+    rewrite_part(path, 'xl/_rels/workbook.xml.rels', lambda xml: xml.replace(
+        '</Relationships>', '<Relationship Id="rIdChain" Target="calcChain.xml" Type="http://schemas.openxmlformats.org'
+                            '/officeDocument/2006/relationships/calcChain"/></Relationships>'))
+    rewrite_part(path, '[Content_Types].xml', lambda xml: xml.replace(
+        '</Types>', '<Override PartName="/xl/calcChain.xml" ContentType="application/vnd.openxmlformats-officedocument.'
+                    'spreadsheetml.calcChain+xml"/></Types>'))
+
+
+def read_sheet(path, sheet=0):
+    """
+    Returns what a reader of the workbook sees: values and fill colors of cells and data validations
+    """
+    wb = load_workbook(path)
+    ws = wb.worksheets[sheet]
+    cells = {cell.coordinate: (cell.value, cell.fill.fgColor.rgb if cell.fill.fill_type else None)
+             for row in ws.iter_rows() for cell in row if cell.value is not None or cell.fill.fill_type}
+    validations = sorted((dv.type, dv.formula1, str(dv.sqref)) for dv in ws.data_validations.dataValidation)
+    return cells, validations
+
+
+def fix(path, out_path, engine, **options):
+    shutil.copyfile(path, out_path)
+    XLSXParser(str(out_path), True, engine=engine, **options).find_errors()
+    return out_path
+
+
+def save_changes(path, out_path, changes, engine):
+    xl = XLSXParser(str(path), False, engine=engine, output_path=str(out_path))
+    xl.sheet_changes = {0: changes}
+    xl.save()
+    return out_path
+
+
+@pytest.mark.parametrize('price_mode', ('formula', 'value'))
+def test_patch_matches_openpyxl(tmp_path, price_mode):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    patched = fix(path, tmp_path / 'patch.xlsx', 'patch', price_mode=price_mode)
+    saved = fix(path, tmp_path / 'openpyxl.xlsx', 'openpyxl', price_mode=price_mode)
+    assert read_sheet(patched) == read_sheet(saved)
+    assert read_sheet(patched, 1) == read_sheet(path, 1)  # reference pages are copied as is
+    with zipfile.ZipFile(path) as source, zipfile.ZipFile(patched) as result:
+        sheet_path = get_sheet_paths(source)[1]
+        assert source.read(sheet_path) == result.read(sheet_path)
+
+
+def test_shared_strings_become_numbers(tmp_path):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    assert '<c r="G5" t="s"' in sheet_xml(path)  # '2,5' is a shared string
+    patched = fix(path, tmp_path / 'patch.xlsx', 'patch')
+    xml = sheet_xml(patched)
+    assert '<c r="G5" t="s"' not in xml
+    ws = load_workbook(patched).worksheets[0]
+    assert (ws['G5'].value, ws['F6'].value, ws['H7'].value, ws['G7'].value) == (2.5, 1.5, 7.25, 10.12346)
+
+
+def test_new_fills(tmp_path):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    patched = fix(path, tmp_path / 'patch.xlsx', 'patch')
+    cells, validations = read_sheet(patched)
+    assert cells['F7'] == ('x', 'FFFF0000')
+    assert cells['H6'] == ('abc', 'FFFF0000')
+    assert cells['D6'] == ('каждый день', 'FFFFF200')
+    assert cells['E7'] == ('м²', 'FFE3B778')
+    assert cells['C5'] == ('работа 1', None)  # style of untouched cells is not changed
+
+
+def test_self_closing_rows_and_cells(tmp_path):
+    rows = ROWS[:2] + ((None, ) * 7, ) + ROWS[2:]
+    path = make_workbook(tmp_path / 'book.xlsx', rows)
+    rewrite_part(path, 'xl/worksheets/sheet1.xml', lambda xml: re.sub(r'<row r="7".*?</row>', '<row r="7"/>', xml))
+    xml = sheet_xml(path)
+    assert '<row r="7"/>' in xml and re.search(r'<c r="I5" s="1"[^>]*/>', xml)
+    changes = ChangeSet()
+    changes.add_value(7, 6, None, 3)
+    changes.add_fill(7, 4, 'yellow_fill')
+    changes.add_value(5, 9, None, '=F5*365*G5*H5/1000')
+    changes.add_fill(5, 9, 'red_fill')
+    patched = save_changes(path, tmp_path / 'patch.xlsx', changes, 'patch')
+    saved = save_changes(path, tmp_path / 'openpyxl.xlsx', changes, 'openpyxl')
+    assert read_sheet(patched) == read_sheet(saved)
+    cells, validations = read_sheet(patched)
+    assert cells['F7'] == (3, None) and cells['D7'] == (None, 'FFFFF200')
+    assert cells['I5'] == ('=F5*365*G5*H5/1000', 'FFFF0000')
+    assert load_workbook(patched).worksheets[0]['I5'].font.bold  # the rest of the style is kept with new fill
+
+
+def test_fallback_on_patch_error(tmp_path, caplog):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    rewrite_part(path, 'xl/worksheets/sheet1.xml', lambda xml: xml.replace(
+        '<f>F8*1*G8*H8/1000</f>', '<f t="shared" ref="I8" si="0">F8*1*G8*H8/1000</f>'))
+    with caplog.at_level(logging.WARNING, logger='xlsx_parser'):
+        patched = fix(path, tmp_path / 'patch.xlsx', 'patch', price_mode='value')
+    assert 'shared or array formula' in caplog.text
+    saved = fix(path, tmp_path / 'openpyxl.xlsx', 'openpyxl', price_mode='value')
+    assert read_sheet(patched) == read_sheet(saved)
+    assert read_sheet(patched)[0]['I8'] == (1.0, None)
+
+
+def test_calc_chain_dropped_when_formulas_replaced(tmp_path):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    add_calc_chain(path)
+    patched = fix(path, tmp_path / 'patch.xlsx', 'patch', price_mode='value')
+    with zipfile.ZipFile(patched) as archive:
+        assert 'xl/calcChain.xml' not in archive.namelist()
+        assert 'calcChain' not in archive.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+        assert 'calcChain' not in archive.read('[Content_Types].xml').decode('utf-8')
+    assert read_sheet(patched)[0]['I8'] == (1.0, None)
+
+
+def test_calc_chain_kept_when_formulas_kept(tmp_path):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    add_calc_chain(path)
+    patched = fix(path, tmp_path / 'patch.xlsx', 'patch', price_mode='formula')
+    with zipfile.ZipFile(patched) as archive:
+        assert archive.read('xl/calcChain.xml').decode('utf-8') == CALC_CHAIN
+        assert 'calcChain' in archive.read('[Content_Types].xml').decode('utf-8')
+
+
+def test_dimension_widened(tmp_path):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    assert '<dimension ref="C4:I8" />' in sheet_xml(path)
+    changes = ChangeSet()
+    changes.add_value(8, 12, None, 'примечание')
+    patched = save_changes(path, tmp_path / 'patch.xlsx', changes, 'patch')
+    assert '<dimension ref="C4:L8" />' in sheet_xml(patched)
+    wb = load_workbook(patched, read_only=True)  # read-only reader takes size of sheet from dimension
+    assert wb.worksheets[0].max_column == 12
+    assert list(wb.worksheets[0].iter_rows(min_row=8, max_row=8, min_col=12, values_only=True)) == [('примечание', )]
+
+
+def test_cache_replays_errors_and_restores_marks(tmp_path):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    cache = FingerprintCache(str(tmp_path / 'cache'))
+    runs = []
+    for _ in range(2):
+        xl = XLSXParser(path, False, cache=cache)
+        xl.find_errors()
+        runs.append((xl.counters, xl.changes.suggestions))
+    assert runs[1][0]['skipped'] == 4 and runs[1][0]['scanned'] == 0
+    for kind in ('number', 'period', 'unit'):
+        assert runs[1][0][kind] == runs[0][0][kind] > 0
+    assert runs[1][1] == runs[0][1]
+    wb = load_workbook(path)
+    wb.worksheets[0]['H6'].fill = PatternFill()  # highlight removed by hand
+    wb.save(path)
+    xl = XLSXParser(path, False, cache=cache)
+    assert xl.find_errors()
+    assert xl.counters['skipped'] == 3 and list(xl.changes.fills) == [(6, 8)]
+    assert read_sheet(path)[0]['H6'] == ('abc', 'FFFF0000')
+
+
+
+def test_unchanged_file_is_not_loaded(tmp_path):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    cache = FingerprintCache(str(tmp_path / 'cache'))
+    XLSXParser(path, True, cache=cache).find_errors()
+    xl = XLSXParser(path, True, cache=cache)
+    assert xl._wb is None and not xl.find_errors() and not xl.changes
+    checked = XLSXParser(path, True, cache=cache, export_path=str(tmp_path / 'rows.csv'))  # export reads the data
+    assert checked._wb is not None and not checked.find_errors()
+    assert dict(xl.counters, exported=0) == dict(checked.counters, exported=0)
+    assert xl.changes.suggestions == checked.changes.suggestions
+    os.utime(path, (1, 1))  # same content, other time of modification
+    assert XLSXParser(path, True, cache=cache).cached_run is not None
+    assert XLSXParser(path, True, cache=cache, autocorrect=0.5).cached_run is None
+    wb = load_workbook(path)
+    wb.worksheets[0]['F5'] = 'x'
+    wb.save(path)
+    xl = XLSXParser(path, True, cache=cache)
+    assert xl.cached_run is None and xl._wb is not None
+    assert xl.find_errors() and xl.counters['skipped'] == 3
+
+@pytest.mark.parametrize('autocorrect, replaced', ((None, False), (0.9, True)))
+def test_suggestion_with_full_similarity_needs_autocorrect(tmp_path, autocorrect, replaced):
+    rows = (('работа 1', 'раз в день', 'аааа', 1, 2, 100, None),
+            ('работа 2', ' раз  в  дёнь', 'шт', 1, 2, 100, None),
+            ('работа 3', 'раз в день', 'МВт', 1, 2, 100, None))
+    # 'ааа' and 'аааа' have the same n-grams, 'МВт' differs from 'мВт' only by case
+    path = make_workbook(tmp_path / 'book.xlsx', rows, units=('ааа', 'шт', 'мВт'))
+    xl = XLSXParser(path, False, dry_run=True, autocorrect=autocorrect)
+    xl.find_errors()
+    assert xl.changes.values[(6, 4)] == (' раз  в  дёнь', 'раз в день')  # whitespace and 'ё' - always replaced
+    for cell, suggestion in (((5, 5), 'ааа'), ((7, 5), 'мВт')):  # case is not ignored without autocorrect
+        assert (cell in xl.changes.values) == replaced
+        if not replaced:
+            assert xl.changes.suggestions[cell] == (suggestion, 1.0)
+    assert xl.counters['unit'] == (0 if replaced else 2)
+
+
+@pytest.mark.parametrize('engine', XLSXParser.ENGINES)
+def test_validators_updated_when_list_and_data_grow(tmp_path, engine):
+    path = fix(make_workbook(tmp_path / 'book.xlsx'), tmp_path / 'fixed.xlsx', engine)
+    wb = load_workbook(path)
+    wb.worksheets[0].append((None, None, 'работа 5', 'раз в неделю', 'шт', 1, 1, 1))
+    wb.worksheets[1].append(('раз в неделю', ))
+    wb.save(path)
+    xl = XLSXParser(str(path), True, engine=engine)
+    assert xl.find_errors()
+    assert not xl.changes.validators and sorted(xl.changes.validator_updates) == [0, 1]
+    assert read_sheet(path)[1] == [('list', "'Единицы'!$A$1:$A$3", 'E5:E9'), ('list', "'Периоды'!$A$1:$A$4", 'D5:D9')]
+    xl = XLSXParser(str(path), True, engine=engine)
+    xl.find_errors()
+    assert xl.counters['validator_ranges'] == 0
+
+
+def test_cell_messages_in_prescan_mode(tmp_path, caplog):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    cells = []
+    for prescan in (True, False):
+        caplog.clear()
+        with caplog.at_level(logging.WARNING, logger='xlsx_parser'):
+            XLSXParser(path, False, prescan=prescan, dry_run=True).find_errors()
+        cells.append(sorted((record.cell, record.kind) for record in caplog.records if hasattr(record, 'cell')))
+    assert cells[0] == cells[1]  # read-only pre-scan reports every found error like the full check
+    assert ('F7', 'number') in cells[0] and ('H6', 'number') in cells[0] and ('D6', 'period') in cells[0]
+
+
+def test_batch_keeps_relative_paths(tmp_path):
+    for directory in ('a', 'b'):
+        (tmp_path / 'in' / directory).mkdir(parents=True)
+        make_workbook(tmp_path / 'in' / directory / 'book.xlsx')
+    results = validate_batch(str(tmp_path / 'in' / '**' / '*.xlsx'), True, 1, str(tmp_path / 'out'),
+                             str(tmp_path / 'reports'), str(tmp_path / 'export'))
+    assert [result.error for result in results] == [None, None]
+    for directory in ('a', 'b'):  # directories are created and same names of nested directories do not collide
+        assert (tmp_path / 'out' / directory / 'book.xlsx').exists()
+        assert (tmp_path / 'reports' / directory / 'book.json').exists()
+        assert (tmp_path / 'export' / directory / 'book.csv').exists()
+
+
+def test_enable_console_adds_one_handler():
+    logger = logging.getLogger('xlsx_parser')
+    handler = enable_console()
+    try:
+        assert enable_console(logging.DEBUG) is handler and logger.handlers.count(handler) == 1
+        assert logger.level == logging.DEBUG
+        logger.removeHandler(handler)
+        other = enable_console()
+        logger.removeHandler(other)
+        assert other is not handler  # handler removed from the logger is not reused
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+
+
+def test_price_modes(tmp_path):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    cells = read_sheet(fix(path, tmp_path / 'value.xlsx', 'openpyxl', price_mode='value'))[0]
+    assert (cells['I5'][0], cells['I8'][0]) == (91.25, 1.0)  # 1 * 365 * 2.5 * 100 / 1000 and 2 * 1 * 5 * 100 / 1000
+    assert 'I6' not in cells and 'I7' not in cells  # no cost without period and numbers
+    both = fix(path, tmp_path / 'both.xlsx', 'patch', price_mode='both')
+    cells = read_sheet(both)[0]
+    assert (cells['I5'][0], cells['I8'][0]) == ('=F5*365*G5*H5/1000', '=F8*1*G8*H8/1000')
+    sheet = load_workbook(both, data_only=True).worksheets[0]  # cached results are seen without calculation
+    assert (sheet['I5'].value, sheet['I8'].value) == (91.25, 1)
+    xl = XLSXParser(both, False, price_mode='both', engine='patch', dry_run=True)
+    assert not xl.find_errors()  # formulas and their results are already written
+    assert xl.get_cached_values(9) == (91.25, None, None, 1)
+
+
+def test_compute_price_without_numpy(monkeypatch):
+    pytest.importorskip('numpy')
+    rows = (('1', '2', '2,5', '100'), ('2', '0', 'inf', '4'), ('nan', '3', '4', '4'), ('1', '0', '4', 'x'))
+    n, amount, tariff, periodicity = (normalize_num_column(column)[2] for column in zip(*rows))
+    xl = XLSXParser.__new__(XLSXParser)  # compute_price does not need a workbook
+    costs = [list(xl.compute_price(periodicity, n, amount, tariff))]
+    monkeypatch.setattr(xlsx_parser, '_numpy', None)
+    costs.append(list(xl.compute_price(periodicity, n, amount, tariff)))
+    assert costs[0] == costs[1] == [0.5, None, None, None]  # nan (inf * 0 and from 'nan') is not a cost
+
+
+NUMBER_CELLS = (3, 2.5, '-12,5', '12,', 'a,b', '', None, '=F5*2', ' 7 ', 0.1234567, '0,1234567', True, '-12,5')
+
+
+def test_normalize_num_column():
+    is_fixed, is_error, numbers = normalize_num_column(NUMBER_CELLS)
+    assert list(numbers) == [3, 2.5, -12.5, None, None, None, None, None, 7, 0.12346, 0.12346, 1, -12.5]
+    assert [i for i, flag in enumerate(is_fixed) if flag] == [2, 10, 12]  # written with comma
+    assert [i for i, flag in enumerate(is_error) if flag] == [3, 4, 5]  # '12,', 'a,b' and '' are not numbers
+    assert list(numbers.present) == [1, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1]
+
+
+def test_normalize_num_column_without_numpy(monkeypatch):
+    pytest.importorskip('numpy')
+    results = [normalize_num_column(NUMBER_CELLS)]
+    monkeypatch.setattr(xlsx_parser, '_numpy', None)
+    results.append(normalize_num_column(NUMBER_CELLS))
+    (fixed, errors, numbers), (fixed_python, errors_python, numbers_python) = results
+    assert (fixed, errors, list(numbers), numbers.present) == \
+        (fixed_python, errors_python, list(numbers_python), numbers_python.present)
+
+
+@pytest.mark.parametrize('prescan', (True, False))
+def test_blank_rows_inside_data(tmp_path, prescan):
+    rows = ROWS[:2] + ((None, ) * 7, ) * 3 + (('работа 5', 'раз в год', 'шт', 'y', 1, 1, None),
+                                              ('работа 6', None, None, None, None, None, None))
+    path = make_workbook(tmp_path / 'book.xlsx', rows)
+    wb = load_workbook(path)
+    wb.worksheets[0]['E30'].font = Font(italic=True)  # styled empty cells after data are not rows of data
+    wb.save(path)
+    xl = XLSXParser(path, True, prescan=prescan, dry_run=True)
+    xl.find_errors()
+    assert xl.ending_row == 11  # the last row has only a name in column C
+    assert (10, 6) in xl.changes.fills  # error after empty rows is found
+    assert sorted(xl.changes.validators.values()) == [['D5:D11'], ['E5:E11']]
+
+
+def test_validations_read_after_sheet_data(tmp_path):
+    path = fix(make_workbook(tmp_path / 'book.xlsx'), tmp_path / 'fixed.xlsx', 'openpyxl')
+    expected = [(dv.type, dv.formula1, str(dv.sqref)) for dv in load_workbook(path).worksheets[0].data_validations
+                .dataValidation]
+    assert len(expected) == 2
+    xml = sheet_xml(path).encode('utf-8')
+    empty = re.sub(rb'<sheetData>.*</sheetData>', b'<sheetData/>', xml, flags=re.DOTALL)
+    for source, chunk_size in ((xml, 7), (xml, 50), (xml, 1 << 20), (empty, 7)):  # the end of sheetData is split
+        validations = read_data_validations(io.BytesIO(source), chunk_size)       # between chunks too
+        assert [(dv.type, dv.formula1, str(dv.sqref)) for dv in validations] == expected
+
+
+@pytest.mark.parametrize('prescan', (True, False))
+def test_wrong_dimension(tmp_path, prescan):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    for sheet_path in ('xl/worksheets/sheet1.xml', 'xl/worksheets/sheet2.xml'):  # data and the list of periods
+        rewrite_part(path, sheet_path, lambda xml: re.sub(r'<dimension ref="[^"]*"', '<dimension ref="A1"', xml))
+    xl = XLSXParser(path, True, prescan=prescan, dry_run=True)
+    assert xl.find_errors()
+    assert xl.ending_row == 8 and xl.period_list == PERIODS
+    assert (xl.counters['number'], xl.counters['period'], xl.counters['unit']) == (2, 1, 1)
+
+
+def test_export_csv(tmp_path):
+    path = make_workbook(tmp_path / 'book.xlsx')
+    xl = XLSXParser(path, True, dry_run=True, export_path=str(tmp_path / 'rows.csv'))
+    xl.find_errors()
+    assert xl.counters['exported'] == 4
+    with open(tmp_path / 'rows.csv', encoding='utf-8', newline='') as f:
+        assert list(csv.reader(f)) == [list(EXPORT_FIELDS)] + [['' if value is None else str(value) for value in row]
+                                                               for row in EXPORTED]
+
+
+def test_export_of_sheets_merged_in_order(tmp_path):
+    path = add_sheet_copies(make_workbook(tmp_path / 'book.xlsx'), 2)
+    result = validate_file(path, dry_run=True, export_path=str(tmp_path / 'rows.csv'), all_sheets=True,
+                           sheet_workers=2)
+    assert result.error is None and result.counters['exported'] == 12
+    with open(tmp_path / 'rows.csv', encoding='utf-8', newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == list(EXPORT_FIELDS) and list(EXPORT_FIELDS) not in rows[1:]  # one header
+    assert [(row[0], row[1]) for row in rows[1:]] == [(title, str(row[1])) for title in ('Смета', 'Смета 2', 'Смета 3')
+                                                      for row in EXPORTED]
+
+
+def test_export_parquet(tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    path = add_sheet_copies(make_workbook(tmp_path / 'book.xlsx'), 1)
+    XLSXParser(path, True, dry_run=True, export_path=str(tmp_path / 'rows.parquet')).find_errors()
+    assert parquet.read_table(str(tmp_path / 'rows.parquet')).to_pylist() == [dict(zip(EXPORT_FIELDS, row))
+                                                                              for row in EXPORTED]
+    result = validate_file(path, dry_run=True, export_path=str(tmp_path / 'all.parquet'), all_sheets=True,
+                           sheet_workers=1)
+    assert result.error is None
+    assert parquet.ParquetFile(str(tmp_path / 'all.parquet')).num_row_groups == 2  # row groups of sheets are copied
+    assert parquet.read_table(str(tmp_path / 'all.parquet')).to_pylist() == [
+        dict(zip(EXPORT_FIELDS, (title, ) + row[1:])) for title in ('Смета', 'Смета 2') for row in EXPORTED]
+
+
+def test_sheets_checked_alike_by_engines_and_workers(tmp_path):
+    path = add_sheet_copies(make_workbook(tmp_path / 'book.xlsx'), 2)
+    wb = load_workbook(path)
+    wb['Смета 3']['E5'] = 'м²'  # the last sheet has one more error
+    wb.save(path)
+    runs = []
+    for engine in XLSXParser.ENGINES:
+        for workers in (1, 2):
+            out_path = str(tmp_path / '{}-{}.xlsx'.format(engine, workers))
+            report_path = str(tmp_path / '{}-{}.json'.format(engine, workers))
+            shutil.copyfile(path, out_path)
+            result = validate_file(out_path, report_path=report_path, all_sheets=True, sheet_workers=workers,
+                                   engine=engine)
+            assert result.error is None and result.is_modified
+            with open(report_path, encoding='utf-8') as f:
+                runs.append((result.counters, json.load(f), [read_sheet(out_path, sheet) for sheet in (0, 3, 4)]))
+    assert all(run == runs[0] for run in runs[1:])
+    counters, report, sheets = runs[0]
+    assert list(report) == ['Смета', 'Смета 2', 'Смета 3']
+    assert (counters['number'], counters['period'], counters['unit']) == (6, 3, 4)
+    assert sheets[0] == sheets[1] != sheets[2] and sheets[2][0]['E5'] == ('м²', 'FFE3B778')
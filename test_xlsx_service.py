@@ -0,0 +1,124 @@
+import asyncio
+import base64
+import io
+import json
+import os
+
+from openpyxl import load_workbook
+
+from test_xlsx_parser import make_workbook
+from xlsx_service import ValidationService
+
+
+def run_service(tmp_path, scenario, **options):
+    """
+    Starts service with one worker on Unix socket, runs scenario(service, socket path) and stops the service
+    """
+    async def main():
+        service = ValidationService(workers=1, **options)
+        unix_path = str(tmp_path / 'service.sock')
+        task = asyncio.ensure_future(service.serve(unix_path=unix_path))
+        while not os.path.exists(unix_path):
+            await asyncio.sleep(0.01)
+        try:
+            return await scenario(service, unix_path)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    return asyncio.run(main())
+
+
+async def request(unix_path, raw, wait=None):
+    """
+    Sends raw request (and waits before closing its writing side if wait is given), returns status, head and payload
+    """
+    reader, writer = await asyncio.open_unix_connection(unix_path)
+    writer.write(raw)
+    await writer.drain()
+    if wait is not None:
+        await asyncio.sleep(wait)
+    response = await reader.read()
+    writer.close()
+    head, body = response.split(b'\r\n\r\n', 1)
+    return int(head.split()[1]), head.decode('latin-1'), json.loads(body)
+
+
+def post(target, body, content_type='application/octet-stream'):
+    return ('POST {} HTTP/1.1\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+        target, content_type, len(body))).encode('latin-1') + body
+
+
+def post_json(payload):
+    return post('/validate', json.dumps(payload).encode('utf-8'), 'application/json')
+
+
+def test_upload(tmp_path):
+    with open(make_workbook(tmp_path / 'book.xlsx'), 'rb') as f:
+        data = f.read()
+
+    async def scenario(service, unix_path):
+        return await request(unix_path, post('/validate?validators=1', data))
+    status, head, payload = run_service(tmp_path, scenario)
+    assert status == 200 and payload['is_modified'] and payload['path'] is None
+    assert payload['report']['suggestions']
+    ws = load_workbook(io.BytesIO(base64.b64decode(payload['workbook']))).worksheets[0]
+    assert ws['G7'].value == 10.12346 and ws.data_validations.dataValidation
+
+
+def test_path_requests_stay_in_root(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    path = make_workbook(root / 'book.xlsx')
+    make_workbook(tmp_path / 'outside.xlsx')
+
+    async def scenario(service, unix_path):
+        return [await request(unix_path, post_json(payload)) for payload in (
+            {'path': '../outside.xlsx'}, {'path': 'book.xlsx', 'output': '../fixed.xlsx'}, {'path': 'book.xlsx'})]
+    responses = run_service(tmp_path, scenario, root=str(root))
+    assert [status for status, head, payload in responses] == [403, 403, 200]
+    assert responses[2][2]['is_modified'] and responses[2][2]['summary']['output'] == path
+    assert load_workbook(path).worksheets[0]['G7'].value == 10.12346
+    assert sorted(os.listdir(root)) == ['book.xlsx'] and not os.path.exists(tmp_path / 'fixed.xlsx')
+
+
+def test_path_requests_off_without_root(tmp_path):
+    make_workbook(tmp_path / 'book.xlsx')
+
+    async def scenario(service, unix_path):
+        return await request(unix_path, post_json({'path': str(tmp_path / 'book.xlsx')}))
+    assert run_service(tmp_path, scenario)[0] == 403
+
+
+def test_busy_slots(tmp_path):
+    async def scenario(service, unix_path):
+        service.jobs = service.max_jobs  # all slots are taken by running jobs
+        return await request(unix_path, post('/validate', b'PK'))
+    status, head, payload = run_service(tmp_path, scenario, max_jobs=1)
+    assert status == 503 and 'Retry-After: 1' in head
+
+
+def test_slow_and_large_requests(tmp_path):
+    async def scenario(service, unix_path):
+        return [await request(unix_path, b'POST /validate HTTP/1.1\r\nContent-Length: 10\r\n', wait=0.5),
+                await request(unix_path, b'POST /validate HTTP/1.1\r\nContent-Length: 10\r\n\r\nPK', wait=0.5),
+                await request(unix_path, post('/validate', b'x' * 101))]
+    responses = run_service(tmp_path, scenario, read_timeout=0.2, max_body=100)
+    assert [status for status, head, payload in responses] == [408, 408, 413]
+
+
+def test_timed_out_job_does_not_write(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    path = make_workbook(root / 'book.xlsx')
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    async def scenario(service, unix_path):
+        response = await request(unix_path, post_json({'path': 'book.xlsx'}))
+        while service.jobs:  # the job goes on after the answer
+            await asyncio.sleep(0.05)
+        return response
+    assert run_service(tmp_path, scenario, root=str(root), timeout=0.001)[0] == 504
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert os.listdir(root) == ['book.xlsx']
@@ -1,10 +1,26 @@
-from collections import OrderedDict
+import glob
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from itertools import islice, repeat
+from contextlib import contextmanager
+from functools import partial
+from operator import itemgetter
+from xml.etree.ElementTree import fromstring, tostring
 
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill
-from openpyxl.utils.exceptions import InvalidFileException
-from openpyxl.worksheet.datavalidation import DataValidation
-from openpyxl.utils import get_column_letter, column_index_from_string
+# openpyxl and numpy are imported on first use, so importing the module (or running CLI with --help) stays cheap
+logger = logging.getLogger('xlsx_parser')  # nothing is written to console unless enable_console() is called
+logger.addHandler(logging.NullHandler())
 
 
 # Custom Errors
@@ -29,7 +45,94 @@ class InputError(Exception):
     pass
 
 
+class PatchError(Exception):
+    """
+    Raise when workbook xml can not be patched directly and has to be saved by openpyxl
+    """
+    pass
+
+
 # Static Service functions
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+ROOT_RE = re.compile(rb'<(?:\w+:)?worksheet\b[^>]*>')  # start tag of worksheet xml, declares namespaces
+SHEET_DATA_END_RE = re.compile(rb'</(?:\w+:)?sheetData\s*>|<(?:\w+:)?sheetData\s*/>')  # rows can not contain it
+_numpy = False  # numpy module after the first import attempt (None if it is not installed), False - not tried yet
+_column_letter = None  # functions of openpyxl, imported on first call as openpyxl is loaded only when it is needed
+_column_index = None
+_console = None  # handler added by enable_console
+_saxutils = None  # xml.sax.saxutils, imported on first use by the patch engine as it pulls in urllib
+
+
+def get_numpy():
+    """
+    Imports numpy on first call, numpy is optional and columns are normalized and computed in pure python without it
+    :return: module or None
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+def get_saxutils():
+    """
+    Imports xml.sax.saxutils on first call, it is needed only to write xml in the patch engine
+    :return: module
+    """
+    global _saxutils
+    if _saxutils is None:
+        from xml.sax import saxutils
+        _saxutils = saxutils
+    return _saxutils
+
+
+def get_column_letter(col_num: int) -> str:
+    """
+    Returns letter of a column by its number (1 -> 'A')
+    :param col_num: int
+    :return: str
+    """
+    global _column_letter
+    if _column_letter is None:
+        from openpyxl.utils.cell import get_column_letter as column_letter
+        _column_letter = column_letter
+    return _column_letter(col_num)
+
+
+def column_index_from_string(letter: str) -> int:
+    """
+    Returns number of a column by its letter ('A' -> 1)
+    :param letter: str
+    :return: int
+    """
+    global _column_index
+    if _column_index is None:
+        from openpyxl.utils.cell import column_index_from_string as column_index
+        _column_index = column_index
+    return _column_index(letter)
+
+
+def enable_console(level: int = logging.INFO) -> logging.Handler:
+    """
+    Turns on output of the log to console (stderr), by default found errors and messages of the run are shown, with
+    logging.DEBUG headers of visited columns too. Repeated calls only change the level and return the handler which is
+    already attached, so messages are not duplicated
+    :param level: int (level of logging)
+    :return: logging.Handler
+    """
+    global _console
+    if _console is None or _console not in logger.handlers:
+        _console = logging.StreamHandler()
+        _console.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        logger.addHandler(_console)
+    logger.setLevel(level)
+    return _console
+
+
 def get_number(st: str) -> tuple:
     """
     Checks if given parameter is number, returns true if it is (number can be divided by comma or by point) returns True
@@ -54,8 +157,7 @@ def get_number(st: str) -> tuple:
                         return True, True, -1 * (float(list_num[0] + '.' + list_num[1]))
                     else:
                         return True, True, float(list_num[0] + '.' + list_num[1])
-            else:
-                return False, False, st
+            return False, False, st
         except AttributeError:
             return False, False, st
 
@@ -91,13 +193,75 @@ def precision_num(num: float) -> int:
         if '.' in s:
             return len(s) - s.find('.') - 1
         else:
-            print('number is not float')
+            logger.debug('number is not float: %s', s)
             return -2
     except(ValueError, TypeError):
-        print('error parsing', -1)
+        logger.debug('error parsing %r', num)
         return -1
 
 
+def round_num(num: float) -> float:
+    """
+    Returns number that should be written to a numeric cell: integers and numbers with no more than 5 signs after comma
+    are returned unchanged, other numbers are truncated to 5 signs
+    :param num: float
+    :return: float
+    """
+    if num != num or num in (float('inf'), float('-inf')) or is_integer(num):
+        return num
+    return trunc(num, 5) if precision_num(num) > 5 else num
+
+
+def normalize_num_column(col: tuple) -> tuple:
+    """
+    Normalizes the whole column of numeric section at once: cells with numbers are taken as they are, strings are
+    parsed once per distinct value (numbers can be divided by comma or by point), cells that are neither numbers nor
+    formulas are errors and numbers are rounded to 5 signs after comma. Uses numpy to find numbers that should be
+    rounded in the whole column at once if it is installed
+    :param col: tuple
+    :return: tuple(is_fixed, is_error, numbers) - masks (bytearray) of numbers written with comma and of errors,
+    NumericColumn of values to write to cells (invalid for everything that is not a number)
+    """
+    size = len(col)
+    values = array('d', bytes(8 * size))
+    valid = bytearray(size)
+    present = bytearray(size)
+    is_fixed = bytearray(size)
+    is_error = bytearray(size)
+    parsed = {}  # string -> (is_num, is_changed, number, is_error), the same strings repeat in a column
+    for i, cel in enumerate(col):
+        if cel is None:
+            continue
+        present[i] = 1
+        kind = type(cel)
+        if kind is int or kind is float:  # most cells already hold numbers
+            values[i] = cel
+            valid[i] = 1
+            continue
+        result = parsed.get(cel) if kind is str else None
+        if result is None:
+            is_num, is_changed, num = get_number(cel)
+            result = (is_num, is_changed, num if is_num else 0.0,
+                      not is_num and not (isinstance(cel, str) and is_formula(cel)))
+            if kind is str:
+                parsed[cel] = result
+        valid[i], is_fixed[i], values[i], is_error[i] = result
+    np = get_numpy()
+    if np is None:
+        for i in range(size):
+            if valid[i]:
+                num = values[i]
+                if not num.is_integer() and round(num, 5) != num:  # more than 5 signs after comma (or nan)
+                    values[i] = round_num(num)
+        return is_fixed, is_error, NumericColumn(values, valid, present)
+    nums = np.frombuffer(values, dtype=float)
+    with np.errstate(invalid='ignore'):
+        suspects = np.isfinite(nums) & (np.round(nums, 5) != nums) & (np.floor(nums) != nums)
+    for i in np.flatnonzero(suspects & np.frombuffer(valid, dtype=bool)).tolist():  # only numbers with more than 5
+        values[i] = round_num(values[i])  # signs after comma can change, exact check is done for them only
+    return is_fixed, is_error, NumericColumn(values, valid, present)
+
+
 def is_formula(st: str) -> bool:
     """
     checks if given parameter is formula from exel
@@ -107,17 +271,13 @@ def is_formula(st: str) -> bool:
     return True if st.startswith('=') else False
 
 
-def get_end_row(col: tuple, start: int) -> int:
+def is_empty(value) -> bool:
     """
-    finds ending row in given column and sums it with start - 1 (to get last row)
-    :param col: tuple
-    :param start: int
-    :return: int
+    Checks if value of a cell is empty (None or empty string)
+    :param value:
+    :return: bool
     """
-    counter = 0
-    while col[counter] is not None and col[counter] != '' and counter < len(col) - 1:
-        counter += 1
-    return start + counter - 1
+    return value is None or value == ''
 
 
 def quote_string(st: str) -> str:
@@ -129,6 +289,39 @@ def quote_string(st: str) -> str:
     return "'{}'".format(st)
 
 
+def read_data_validations(source, chunk_size: int = 1 << 20) -> list:
+    """
+    Returns data validations stored in worksheet xml, needed for read-only worksheets as openpyxl does not parse them
+    in that mode. Rows are not parsed: bytes of the xml are only searched for the end of sheetData, and the part after
+    it is parsed together with the start tag of worksheet (it declares namespaces)
+    :param source: file-like object with worksheet xml (binary)
+    :param chunk_size: int (bytes read at once)
+    :return: list (of DataValidation)
+    """
+    from openpyxl.worksheet.datavalidation import DataValidation
+    root = None
+    buffer = b''
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return []  # worksheet without sheetData
+        buffer += chunk
+        if root is None:
+            match = ROOT_RE.search(buffer)
+            if match is None:
+                continue
+            root = match.group(0)
+            buffer = buffer[match.end():]
+        match = SHEET_DATA_END_RE.search(buffer)
+        if match is not None:
+            tail = buffer[match.end():] + source.read()
+            break
+        buffer = buffer[-64:]  # the end of sheetData can be split between chunks
+    # validations of extensions (x14) are in other namespace and are not read, as openpyxl does not read them either
+    return [DataValidation.from_tree(element)
+            for element in fromstring(root + tail).iter(SHEET_NS + 'dataValidation')]
+
+
 def parse_input(st: str) -> tuple:
     """
     parse user input string with path and boolean variable that says if validator should be used
@@ -149,9 +342,959 @@ def parse_input(st: str) -> tuple:
         raise InputError
 
 
+# Column store
+class NumericColumn:
+    """
+    Numbers of a checked column stored compactly: array of doubles with mask of cells that hold numbers (valid) and
+    mask of non-empty cells (present), 10 bytes per row instead of boxed python objects
+    """
+    __slots__ = ('values', 'valid', 'present')
+
+    def __init__(self, values: array, valid: bytearray, present: bytearray = None):
+        """
+        :param values: array (of doubles, value of invalid cell does not matter)
+        :param valid: bytearray (1 for cells with numbers)
+        :param present: bytearray (1 for non-empty cells, equals valid if not given)
+        """
+        self.values = values
+        self.valid = valid
+        self.present = valid if present is None else present
+
+    @classmethod
+    def from_values(cls, numbers, raw=None):
+        """
+        Builds column from numbers
+        :param numbers: tuple (numbers, None for cells without number)
+        :param raw: tuple (original values of cells to find empty ones, numbers are used if not given)
+        :return: NumericColumn
+        """
+        return cls(array('d', (0.0 if num is None else num for num in numbers)),
+                   bytearray(num is not None for num in numbers),
+                   None if raw is None else bytearray(value is not None for value in raw))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return 'NumericColumn({})'.format(list(self))
+
+    def __getitem__(self, i: int):
+        return self.values[i] if self.valid[i] else None
+
+    def __iter__(self):
+        return (value if is_valid else None for value, is_valid in zip(self.values, self.valid))
+
+
+class CategoryColumn:
+    """
+    Strings of period or unit column coded by numbers: codes below len(reference list) point to values of the list,
+    other values are interned after them, empty cells are coded with -1. Every distinct value is stored once
+    """
+    __slots__ = ('categories', 'codes')
+
+    def __init__(self, categories: list, codes: array):
+        """
+        :param categories: list (values of reference list followed by other values of the column)
+        :param codes: array (of ints, index in categories or -1)
+        """
+        self.categories = categories
+        self.codes = codes
+
+    @classmethod
+    def from_values(cls, values, reference: tuple = ()):
+        """
+        Builds column from values interning them against reference list
+        :param values: iterable
+        :param reference: tuple (reference list)
+        :return: CategoryColumn
+        """
+        categories = list(reference)
+        index = {value: code for code, value in enumerate(categories)}
+        codes = array('i')
+        for value in values:
+            if value is None or value == '':
+                codes.append(-1)
+                continue
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(categories)
+                categories.append(value)
+            codes.append(code)
+        return cls(categories, codes)
+
+    def map(self, function) -> list:
+        """
+        Applies function to every category once and returns results by rows (None for empty cells)
+        :param function: callable
+        :return: list
+        """
+        table = [function(category) for category in self.categories] + [None]  # code -1 points to the last item
+        return [table[code] for code in self.codes]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __repr__(self):
+        return 'CategoryColumn({})'.format(list(self))
+
+    def __getitem__(self, i: int):
+        code = self.codes[i]
+        return None if code < 0 else self.categories[code]
+
+    def __iter__(self):
+        categories = self.categories + [None]
+        return (categories[code] for code in self.codes)
+
+
+# Reference lists
+def normalize_key(value, ignore_case: bool = True):
+    """
+    Returns key to compare values of reference lists: extra whitespace, 'ё'/'е' difference and case (if ignore_case)
+    are ignored, non-string values are returned unchanged
+    :param value: str
+    :param ignore_case: bool
+    :return: str
+    """
+    if not isinstance(value, str):
+        return value
+    key = ' '.join(value.replace('ё', 'е').replace('Ё', 'Е').split())
+    return key.casefold() if ignore_case else key
+
+
+def get_ngrams(key: str, size: int = 3) -> set:
+    """
+    Returns set of n-grams of a string padded with spaces (so short strings have n-grams too)
+    :param key: str
+    :param size: int
+    :return: set
+    """
+    key = ' ' + key + ' '
+    return {key[i:i + size] for i in range(max(len(key) - size + 1, 1))}
+
+
+class ReferenceIndex:
+    """
+    Index of reference list (periods or units) built once per workbook: exact values, normalized keys and n-grams of
+    keys used to suggest the closest valid value for an error
+    """
+
+    def __init__(self, values: tuple):
+        self.values = tuple(values)
+        self.exact = set(self.values)
+        self.keys = {}  # normalized key with case kept -> the first value of list with this key
+        self._ngrams = {}  # n-gram -> list of numbers of values
+        self._sizes = []  # number of n-grams of every value
+        self._suggestions = {}  # already found suggestions: value -> (suggestion, similarity)
+        for i, value in enumerate(self.values):
+            self.keys.setdefault(normalize_key(value, ignore_case=False), value)
+            key = normalize_key(value)
+            grams = get_ngrams(key) if isinstance(key, str) else set()
+            self._sizes.append(len(grams))
+            for gram in grams:
+                self._ngrams.setdefault(gram, []).append(i)
+
+    def __contains__(self, value) -> bool:
+        return value in self.exact
+
+    def find(self, value):
+        """
+        Returns value of the list that differs from the given one only by whitespace or 'ё'/'е' or None. Case is not
+        ignored here as it carries meaning in units (мВт and МВт), values differing by case are found by suggest
+        :param value: str
+        :return: str
+        """
+        return self.keys.get(normalize_key(value, ignore_case=False))
+
+    def suggest(self, value) -> tuple:
+        """
+        Returns the closest value of the list and its similarity (Dice coefficient of n-grams, from 0 to 1)
+        :param value: str
+        :return: tuple(suggestion, similarity), (None, 0) if nothing is similar
+        """
+        if value not in self._suggestions:
+            key = normalize_key(value)
+            best = (None, 0.0)
+            if isinstance(key, str):
+                grams = get_ngrams(key)
+                common = Counter(i for gram in grams for i in self._ngrams.get(gram, ()))
+                for i, amount in common.items():
+                    similarity = 2.0 * amount / (len(grams) + self._sizes[i])
+                    if similarity > best[1]:
+                        best = (self.values[i], similarity)
+            self._suggestions[value] = best
+        return self._suggestions[value]
+
+
+# Change set
+class ChangeSet:
+    """
+    Stores changes that should be made to a worksheet: new values of cells, fills and validator ranges. Only real
+    differences from the original worksheet are stored
+    """
+
+    def __init__(self):
+        self.values = {}  # (row, column) -> (old value, new value)
+        self.cached = {}  # (row, column) -> cached result of new formula
+        self.fills = {}  # (row, column) -> name of XLSXParser fill attribute
+        self.validators = {}  # name of XLSXParser validator attribute -> list of ranges
+        self.validator_updates = {}  # number of existing data validation of worksheet -> (name of XLSXParser
+        # validator attribute, which formula is set to it, new ranges of it)
+        self.suggestions = {}  # (row, column) -> (suggested value, similarity), only reported, not applied
+
+    def __bool__(self):
+        return bool(self.values or self.fills or self.validators or self.validator_updates)
+
+    def __len__(self):
+        return len(self.values) + len(self.fills) + sum(len(ranges) for ranges in self.validators.values()) + \
+            len(self.validator_updates)
+
+    def add_value(self, row: int, col_num: int, old, new, cached=None, old_cached=None) -> bool:
+        """
+        Stores new value of a cell if it (or cached result of formula) differs from the old one, returns status is_added
+        :param row: int
+        :param col_num: int
+        :param old: old value of the cell
+        :param new: new value of the cell
+        :param cached: number (cached result of new formula)
+        :param old_cached: cached result of old formula
+        :return: bool
+        """
+        same_cached = cached is None or (isinstance(old_cached, (int, float)) and
+                                         abs(cached - old_cached) <= 1e-9 * max(1.0, abs(cached)))
+        if old == new and isinstance(old, str) == isinstance(new, str) and same_cached:  # 1 and 1.0 are the same
+            return False
+        self.values[(row, col_num)] = (old, new)
+        if cached is not None:
+            self.cached[(row, col_num)] = cached
+        return True
+
+    def add_fill(self, row: int, col_num: int, fill: str):
+        """
+        Stores fill of a cell
+        :param row: int
+        :param col_num: int
+        :param fill: str (name of XLSXParser fill attribute)
+        :return:
+        """
+        self.fills[(row, col_num)] = fill
+
+    def add_validator(self, validator: str, cell_range: str):
+        """
+        Stores range of a validator
+        :param validator: str (name of XLSXParser validator attribute)
+        :param cell_range: str
+        :return:
+        """
+        self.validators.setdefault(validator, []).append(cell_range)
+
+    def update_validator(self, index: int, validator: str, sqref: str):
+        """
+        Stores update of existing data validation: formula of given validator and new ranges are set to it
+        :param index: int (number of data validation in worksheet)
+        :param validator: str (name of XLSXParser validator attribute)
+        :param sqref: str (ranges separated by spaces)
+        :return:
+        """
+        self.validator_updates[index] = (validator, sqref)
+
+    def to_dict(self) -> dict:
+        """
+        Returns changes as a dict which can be dumped to JSON report
+        :return: dict
+        """
+        return {'values': [dict({'cell': get_column_letter(col_num) + str(row), 'old': old, 'new': new},
+                                **({'cached': self.cached[(row, col_num)]} if (row, col_num) in self.cached else {}))
+                           for (row, col_num), (old, new) in sorted(self.values.items())],
+                'fills': [{'cell': get_column_letter(col_num) + str(row), 'fill': fill}
+                          for (row, col_num), fill in sorted(self.fills.items())],
+                'validators': self.validators,
+                'validator_updates': [{'index': index, 'validator': validator, 'ranges': sqref}
+                                      for index, (validator, sqref) in sorted(self.validator_updates.items())],
+                'suggestions': [{'cell': get_column_letter(col_num) + str(row), 'suggestion': suggestion,
+                                 'similarity': round(similarity, 3)}
+                                for (row, col_num), (suggestion, similarity) in sorted(self.suggestions.items())]}
+
+    def to_json(self, path: str = None) -> str:
+        """
+        Returns changes as JSON report and writes it to a file if path is given
+        :param path: str
+        :return: str
+        """
+        report = json.dumps(self.to_dict(), ensure_ascii=False, indent=2, default=str)  # dates are written as strings
+        if path is not None:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(report)
+        return report
+
+
+# Patch save engine
+ROW_RE = re.compile(r'<row\b[^>]*?\br="(\d+)"[^>]*?(?:/>|>(.*?)</row>)', re.DOTALL)
+CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.DOTALL)
+ATTR_RE = re.compile(r'([\w:]+)="([^"]*)"')
+XF_RE = re.compile(r'<xf\b[^>]*?(?:/>|>.*?</xf>)', re.DOTALL)
+FILL_RE = re.compile(r'<fill\b[^>]*?(?:/>|>.*?</fill>)', re.DOTALL)
+VALIDATION_RE = re.compile(r'<dataValidation\b[^>]*?(?:/>|>.*?</dataValidation>)', re.DOTALL)
+AFTER_VALIDATIONS = ('hyperlinks', 'printOptions', 'pageMargins', 'pageSetup', 'headerFooter', 'rowBreaks',
+                     'colBreaks', 'customProperties', 'cellWatches', 'ignoredErrors', 'smartTags', 'drawing',
+                     'legacyDrawing', 'legacyDrawingHF', 'picture', 'oleObjects', 'controls', 'webPublishItems',
+                     'tableParts', 'extLst')  # elements that follow dataValidations in worksheet xml schema
+REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+DOC_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+
+def get_rel_targets(archive: zipfile.ZipFile, rels_path: str, base: str) -> tuple:
+    """
+    Reads relationships part and resolves paths of their targets inside archive
+    :param archive: zipfile.ZipFile
+    :param rels_path: str (path of .rels part)
+    :param base: str (directory of the part the relationships belong to)
+    :return: tuple (dict: id of relationship -> path of target, Element of relationships)
+    """
+    rels = fromstring(archive.read(rels_path))
+    return {rel.get('Id'): posixpath.normpath(rel.get('Target')[1:] if rel.get('Target').startswith('/')
+                                              else posixpath.join(base, rel.get('Target')))
+            for rel in rels.iter(REL_NS + 'Relationship')}, rels
+
+
+def get_workbook_path(archive: zipfile.ZipFile) -> str:
+    """
+    Finds path of workbook xml part inside .xlsx archive
+    :param archive: zipfile.ZipFile
+    :return: str
+    """
+    _, rels = get_rel_targets(archive, '_rels/.rels', '')
+    return next(rel.get('Target').lstrip('/') for rel in rels.iter(REL_NS + 'Relationship')
+                if rel.get('Type').endswith('/officeDocument'))
+
+
+def get_sheet_paths(archive: zipfile.ZipFile) -> list:
+    """
+    Finds paths of worksheet xml parts inside .xlsx archive in order of sheets in workbook, chartsheets are skipped as
+    openpyxl skips them in Workbook.worksheets
+    :param archive: zipfile.ZipFile
+    :return: list
+    """
+    workbook_path = get_workbook_path(archive)
+    base, name = posixpath.split(workbook_path)
+    sheet_targets, rels = get_rel_targets(archive, posixpath.join(base, '_rels', name + '.rels'), base)
+    worksheets = {rel.get('Id') for rel in rels.iter(REL_NS + 'Relationship') if rel.get('Type').endswith('/worksheet')}
+    workbook = fromstring(archive.read(workbook_path))
+    return [sheet_targets[sheet.get(DOC_REL_NS + 'id')] for sheet in workbook.iter()
+            if sheet.tag.endswith('}sheet') and sheet.get(DOC_REL_NS + 'id') in worksheets]
+
+
+def drop_calc_chain(archive: zipfile.ZipFile) -> dict:
+    """
+    Returns parts to rewrite to remove calculation chain from workbook (as openpyxl does on save): its relationship in
+    workbook rels and its override in [Content_Types].xml. Calculation chain lists cells with formulas and Excel asks to
+    repair the file if some of them do not contain formulas anymore, without the chain it is rebuilt by Excel
+    :param archive: zipfile.ZipFile
+    :return: dict (path of part -> new content, path of calculation chain -> None; empty if there is no chain)
+    """
+    base, name = posixpath.split(get_workbook_path(archive))
+    rels_path = posixpath.join(base, '_rels', name + '.rels')
+    targets, rels = get_rel_targets(archive, rels_path, base)
+    ids = [rel.get('Id') for rel in rels.iter(REL_NS + 'Relationship') if rel.get('Type').endswith('/calcChain')]
+    if not ids:
+        return {}
+    chain_paths = [targets[rel_id] for rel_id in ids]
+    parts = dict.fromkeys(chain_paths)
+    rels_xml = archive.read(rels_path).decode('utf-8')
+    for rel_id in ids:
+        rels_xml = re.sub(r'<Relationship\b[^>]*\bId="{}"[^>]*/>'.format(re.escape(rel_id)), '', rels_xml)
+    parts[rels_path] = rels_xml.encode('utf-8')
+    types_xml = archive.read('[Content_Types].xml').decode('utf-8')
+    for chain_path in chain_paths:
+        types_xml = re.sub(r'<Override\b[^>]*\bPartName="/{}"[^>]*/>'.format(re.escape(chain_path)), '', types_xml)
+    parts['[Content_Types].xml'] = types_xml.encode('utf-8')
+    return parts
+
+
+def widen_dimension(xml: str, cells) -> str:
+    """
+    Widens range of dimension element of worksheet xml to include given cells (read-only readers rely on it)
+    :param xml: str (worksheet xml)
+    :param cells: iterable (of (row, column number))
+    :return: str
+    """
+    dimension = re.search(r'<dimension\b[^>]*?\bref="([^"]*)"', xml)
+    cells = list(cells)
+    if dimension is None or not cells:
+        return xml
+    from openpyxl.utils.cell import range_boundaries
+    try:
+        bounds = range_boundaries(dimension.group(1))
+    except ValueError:
+        return xml
+    if None in bounds:  # range of whole columns or rows ('A:C')
+        return xml
+    min_col, min_row, max_col, max_row = bounds
+    rows = [row for row, col_num in cells] + [min_row, max_row]
+    cols = [col_num for row, col_num in cells] + [min_col, max_col]
+    ref = '{}{}:{}{}'.format(get_column_letter(min(cols)), min(rows), get_column_letter(max(cols)), max(rows))
+    if ref == dimension.group(1):
+        return xml
+    return xml[:dimension.start(1)] + ref + xml[dimension.end(1):]
+
+
+def number_xml(num) -> str:
+    """
+    Returns text of a number for cell xml, integer numbers are written without fraction part
+    :param num: int, float
+    :return: str
+    """
+    if num != num or num in (float('inf'), float('-inf')):
+        raise PatchError('number {} can not be written to a cell'.format(num))
+    return str(int(num)) if float(num).is_integer() else repr(num)
+
+
+def cell_xml(attrs: dict, value, cached=None) -> str:
+    """
+    Returns xml of a cell with given attributes (type attribute is set according to value)
+    :param attrs: dict (attributes of cell, at least 'r')
+    :param value: new value of a cell (number, bool, str, formula or None)
+    :param cached: number (cached result of formula, read by applications that do not calculate formulas)
+    :return: str
+    """
+    saxutils = get_saxutils()
+    attrs = {key: val for key, val in attrs.items() if key != 't'}
+    if value is None:
+        content = ''
+    elif isinstance(value, bool):
+        attrs['t'] = 'b'
+        content = '<v>{}</v>'.format(int(value))
+    elif isinstance(value, (int, float)):
+        content = '<v>{}</v>'.format(number_xml(value))
+    elif isinstance(value, str) and is_formula(value):
+        content = '<f>{}</f>'.format(saxutils.escape(value[1:]))
+        if cached is not None:
+            content += '<v>{}</v>'.format(number_xml(cached))
+    elif isinstance(value, str):
+        attrs['t'] = 'inlineStr'
+        space = ' xml:space="preserve"' if value != value.strip() else ''
+        content = '<is><t{}>{}</t></is>'.format(space, saxutils.escape(value))
+    else:
+        raise PatchError('value of type {} can not be written to a cell'.format(type(value).__name__))
+    start = '<c' + ''.join(' {}={}'.format(key, saxutils.quoteattr(val)) for key, val in attrs.items())
+    return start + ('>' + content + '</c>' if content else '/>')
+
+
+class StylePatcher:
+    """
+    Adds fills and cell formats (xf) with these fills to styles.xml, reusing already existing ones
+    """
+
+    def __init__(self, xml: str):
+        self.xml = xml
+        fills = re.search(r'<fills\b[^>]*>(.*?)</fills>', xml, re.DOTALL)
+        xfs = re.search(r'<cellXfs\b[^>]*>(.*?)</cellXfs>', xml, re.DOTALL)
+        if fills is None or xfs is None:
+            raise PatchError('styles.xml has no fills or cell formats')
+        self.fills = [self.normalize(fill) for fill in FILL_RE.findall(fills.group(1))]
+        self.xfs = XF_RE.findall(xfs.group(1))
+        self.new_fills = []
+        self.new_xfs = []
+        self._styles = {}  # (old style id, fill xml) -> new style id
+
+    @staticmethod
+    def normalize(xml: str) -> str:
+        return re.sub(r'\s*/>', '/>', xml)
+
+    def get_style(self, style_id: int, fill: str) -> int:
+        """
+        Returns id of cell format equal to the given one but with given fill
+        :param style_id: int (old style id of cell)
+        :param fill: str (xml of fill)
+        :return: int
+        """
+        key = (style_id, fill)
+        if key not in self._styles:
+            fill = self.normalize(fill)
+            all_fills = self.fills + self.new_fills
+            if fill not in all_fills:
+                self.new_fills.append(fill)
+                all_fills.append(fill)
+            fill_id = all_fills.index(fill)
+            if style_id >= len(self.xfs):
+                raise PatchError('cell refers to undefined style {}'.format(style_id))
+            xf = re.sub(r'\s(fillId|applyFill)="[^"]*"', '', self.xfs[style_id])
+            xf = re.sub(r'^<xf\b', '<xf fillId="{}" applyFill="1"'.format(fill_id), xf)
+            all_xfs = self.xfs + self.new_xfs
+            if xf not in all_xfs:
+                self.new_xfs.append(xf)
+                all_xfs.append(xf)
+            self._styles[key] = all_xfs.index(xf)
+        return self._styles[key]
+
+    def patch(self) -> str:
+        """
+        Returns styles.xml with new fills and cell formats
+        :return: str
+        """
+        xml = self.xml
+        for tag, items, new in (('fills', self.fills, self.new_fills), ('cellXfs', self.xfs, self.new_xfs)):
+            if new:
+                xml = re.sub(r'<{0}\b[^>]*>'.format(tag), '<{} count="{}">'.format(tag, len(items) + len(new)), xml,
+                             count=1)
+                xml = xml.replace('</{}>'.format(tag), ''.join(new) + '</{}>'.format(tag), 1)
+        return xml
+
+
+def patch_sheet(xml: str, changes, fills: dict, validators: dict, styles: StylePatcher) -> tuple:
+    """
+    Returns worksheet xml with changed cells, fills and new data validations, untouched rows are copied as is
+    :param xml: str (worksheet xml)
+    :param changes: ChangeSet
+    :param fills: dict (name of fill -> PatternFill)
+    :param validators: dict (name of validator -> DataValidation)
+    :param styles: StylePatcher
+    :return: tuple (xml, bool - some formulas were replaced with values)
+    """
+    quoteattr = get_saxutils().quoteattr
+    removes_formulas = False
+    by_row = {}
+    for row, col_num in list(changes.values) + list(changes.fills):
+        by_row.setdefault(row, set()).add(col_num)
+    parts = []
+    last = 0
+    for match in ROW_RE.finditer(xml):
+        row = int(match.group(1))
+        if row not in by_row:
+            continue
+        cols = by_row.pop(row)
+        cells = []
+        for cell in CELL_RE.finditer(match.group(2) or ''):
+            attrs = dict(ATTR_RE.findall(cell.group(1)))
+            if 'r' not in attrs:
+                raise PatchError('cell without reference in row {}'.format(row))
+            cells.append((column_index_from_string(re.sub(r'\d', '', attrs['r'])), attrs, cell.group(0),
+                          cell.group(2) or ''))
+        existing = {col_num for col_num, attrs, text, content in cells}
+        for col_num in cols - existing:  # new cells are created empty and filled below
+            cells.append((col_num, {'r': get_column_letter(col_num) + str(row)}, None, ''))
+        row_xml = []
+        for col_num, attrs, text, content in sorted(cells, key=lambda cell: cell[0]):
+            if col_num not in cols:
+                row_xml.append(text)
+                continue
+            if (row, col_num) in changes.fills:
+                attrs['s'] = str(styles.get_style(int(attrs.get('s', 0)),
+                                                  tostring(fills[changes.fills[(row, col_num)]].to_tree(),
+                                                           encoding='unicode')))
+            if (row, col_num) in changes.values:
+                new = changes.values[(row, col_num)][1]
+                if '<f' in content and re.search(r'<f\b[^>]*\bt="(shared|array)"', content):
+                    raise PatchError('cell {} contains shared or array formula'.format(attrs['r']))
+                if re.search(r'<f\b', content) and not (isinstance(new, str) and is_formula(new)):
+                    removes_formulas = True
+                row_xml.append(cell_xml(attrs, new, changes.cached.get((row, col_num))))
+            elif text is None:
+                row_xml.append(cell_xml(attrs, None))
+            else:
+                start = '<c' + ''.join(' {}={}'.format(key, quoteattr(val)) for key, val in attrs.items())
+                row_xml.append(start + ('>' + content + '</c>' if content or not text.endswith('/>') else '/>'))
+        start_tag = match.group(0)[:match.group(0).index('>') + 1]
+        if start_tag.endswith('/>'):
+            start_tag = start_tag[:-2] + '>'
+        parts.append(xml[last:match.start()])
+        parts.append(start_tag + ''.join(row_xml) + '</row>')
+        last = match.end()
+    if by_row:
+        raise PatchError('rows {} do not exist in worksheet xml'.format(sorted(by_row)))
+    parts.append(xml[last:])
+    xml = widen_dimension(''.join(parts), list(changes.values) + list(changes.fills))
+    from openpyxl.worksheet.datavalidation import DataValidation
+    new_validations = []
+    for name, ranges in changes.validators.items():
+        dv = DataValidation.from_tree(validators[name].to_tree())  # copy, ranges of template are not changed
+        dv.sqref = ' '.join(ranges)
+        new_validations.append(tostring(dv.to_tree(), encoding='unicode'))
+    if changes.validator_updates:
+        xml = update_validations(xml, changes.validator_updates, validators)
+    if new_validations:
+        xml = add_validations(xml, ''.join(new_validations), len(new_validations))
+    return xml, removes_formulas
+
+
+def update_validations(xml: str, updates: dict, validators: dict) -> str:
+    """
+    Sets formulas of validators and new ranges to existing data validations of worksheet xml
+    :param xml: str (worksheet xml)
+    :param updates: dict (number of data validation -> (name of validator, new ranges), see ChangeSet)
+    :param validators: dict (name of validator -> DataValidation)
+    :return: str
+    """
+    saxutils = get_saxutils()
+    end = xml.rfind('</sheetData>')
+    block = re.compile(r'<dataValidations\b[^>]*>(.*?)</dataValidations>', re.DOTALL).search(xml, max(end, 0))
+    elements = list(VALIDATION_RE.finditer(block.group(1))) if block is not None else []
+    if max(updates) >= len(elements):
+        raise PatchError('data validation {} does not exist in worksheet xml'.format(max(updates)))
+    parts = []
+    last = 0
+    for i, element in enumerate(elements):
+        if i not in updates:
+            continue
+        validator, sqref = updates[i]
+        formula = saxutils.escape(validators[validator].formula1)
+        text, count = re.subn(r'(<(?:\w+:)?formula1>).*?(</(?:\w+:)?formula1>)',
+                              lambda match: match.group(1) + formula + match.group(2),
+                              element.group(0), count=1, flags=re.DOTALL)
+        if not count:
+            raise PatchError('data validation {} has no formula'.format(i))
+        text = re.sub(r'\ssqref="[^"]*"', ' sqref=' + saxutils.quoteattr(sqref), text, count=1)
+        parts.append(block.group(1)[last:element.start()] + text)
+        last = element.end()
+    start = block.start(1)
+    return xml[:start] + ''.join(parts) + block.group(1)[last:] + xml[block.end(1):]
+
+
+def add_validations(xml: str, validations: str, amount: int) -> str:
+    """
+    Adds data validations xml to worksheet xml keeping order of elements required by schema
+    :param xml: str (worksheet xml)
+    :param validations: str (xml of dataValidation elements)
+    :param amount: int (number of added dataValidation elements)
+    :return: str
+    """
+    end = xml.rfind('</sheetData>')
+    if end == -1:
+        end = xml.find('<sheetData')
+    existing = re.compile(r'<dataValidations\b[^>]*?\bcount="(\d+)"[^>]*>').search(xml, end)
+    if existing is not None:
+        count = int(existing.group(1)) + amount
+        xml = xml[:existing.start()] + re.sub(r'count="\d+"', 'count="{}"'.format(count), existing.group(0)) + \
+            xml[existing.end():]
+        close = xml.index('</dataValidations>', existing.start())
+        return xml[:close] + validations + xml[close:]
+    following = re.compile(r'<(?:{})\b'.format('|'.join(AFTER_VALIDATIONS))).search(xml, end)
+    position = following.start() if following is not None else xml.rindex('</worksheet>')
+    return xml[:position] + '<dataValidations count="{}">{}</dataValidations>'.format(amount, validations) + \
+        xml[position:]
+
+
+def patch_workbook(path: str, out_path: str, changes: dict, fills: dict, validators: dict):
+    """
+    Saves changes directly to xml parts of .xlsx archive: only changed worksheets and styles.xml are rewritten, all
+    other parts are copied unchanged. If some formulas are replaced with values calculation chain is removed. Raises
+    PatchError if workbook can not be patched
+    :param path: str (path to original .xlsx file)
+    :param out_path: str (path to save, can be equal to path)
+    :param changes: dict (number of sheet -> ChangeSet)
+    :param fills: dict (name of fill -> PatternFill)
+    :param validators: dict (name of validator -> DataValidation)
+    :return:
+    """
+    with zipfile.ZipFile(path) as archive:
+        sheet_paths = get_sheet_paths(archive)
+        styles_path = next((name for name in archive.namelist() if name.endswith('styles.xml')), None)
+        if styles_path is None:
+            raise PatchError('workbook has no styles.xml')
+        styles = StylePatcher(archive.read(styles_path).decode('utf-8'))
+        patched = {}  # path of part -> new content, None for removed parts
+        removes_formulas = False
+        for sheet, sheet_changes in changes.items():
+            if sheet_changes:
+                xml, removed = patch_sheet(archive.read(sheet_paths[sheet]).decode('utf-8'), sheet_changes, fills,
+                                           validators, styles)
+                patched[sheet_paths[sheet]] = xml.encode('utf-8')
+                removes_formulas = removes_formulas or removed
+        if removes_formulas:
+            patched.update(drop_calc_chain(archive))
+        if styles.new_xfs:
+            patched[styles_path] = styles.patch().encode('utf-8')
+        fd, tmp_path = tempfile.mkstemp(suffix='.xlsx', dir=os.path.dirname(os.path.abspath(out_path)))
+        os.close(fd)
+        try:
+            with zipfile.ZipFile(tmp_path, 'w') as out:
+                for info in archive.infolist():
+                    new_info = zipfile.ZipInfo(info.filename, info.date_time)  # info of source archive is not reused
+                    new_info.compress_type = info.compress_type           # as writing changes it
+                    new_info.external_attr = info.external_attr
+                    if info.filename in patched:
+                        if patched[info.filename] is not None:
+                            out.writestr(new_info, patched[info.filename])
+                    else:  # untouched parts are streamed through without parsing
+                        with archive.open(info) as src, out.open(new_info, 'w') as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
+            shutil.copymode(path, tmp_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, out_path)
+
+
+# Fingerprint cache
+def fingerprint(values) -> str:
+    """
+    Returns short hash of values, integer floats are hashed as integers as they are read back from file this way
+    :param values: iterable
+    :return: str
+    """
+    values = tuple(int(value) if isinstance(value, float) and value.is_integer() else value for value in values)
+    return hashlib.blake2b(repr(values).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def get_file_state(path: str) -> dict:
+    """
+    Returns state of workbook file stored in cache to skip the next run while the file is not changed: its size, time
+    of modification and hash of checksums of all parts of the archive (read from its directory without unpacking)
+    :param path: str
+    :return: dict
+    """
+    stat = os.stat(path)
+    with zipfile.ZipFile(path) as archive:
+        parts = fingerprint(sorted((info.filename, info.CRC, info.file_size) for info in archive.infolist()))
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'parts': parts}
+
+
+def is_file_unchanged(path: str, state: dict) -> bool:
+    """
+    Returns True if the file is in the stored state: its size and time of modification are the same (the archive is
+    not opened) or, if they differ (the file was copied or touched), checksums of its parts are the same
+    :param path: str
+    :param state: dict (from get_file_state)
+    :return: bool
+    """
+    if not state:
+        return False
+    stat = os.stat(path)
+    if stat.st_size == state.get('size') and stat.st_mtime_ns == state.get('mtime'):
+        return True
+    try:
+        return get_file_state(path)['parts'] == state.get('parts')
+    except zipfile.BadZipFile:
+        return False
+
+
+class FingerprintCache:
+    """
+    Sidecar cache of checked workbooks: for every worksheet of a workbook (identified by its real path and number of
+    the sheet) stores hashes of checked rows after the last run, hash of reference lists, header map and options. Every
+    worksheet is stored in its own JSON file, number of files is bounded and least recently used ones are evicted
+    """
+
+    def __init__(self, directory: str = None, max_entries: int = 256):
+        """
+        :param directory: str (directory to store cache in, ~/.cache/xlsx_parser by default)
+        :param max_entries: int (maximum number of stored workbooks)
+        """
+        self.directory = directory or os.path.join(os.path.expanduser('~'), '.cache', 'xlsx_parser')
+        self.max_entries = max_entries
+
+    def entry_path(self, path: str, sheet: int = 0) -> str:
+        """
+        Returns path of cache file of a worksheet
+        :param path: str (path to workbook)
+        :param sheet: int (number of worksheet)
+        :return: str
+        """
+        key = os.path.realpath(path) + ('' if sheet == 0 else '#' + str(sheet))  # first sheet keeps key of workbook
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def load(self, path: str, sheet: int = 0) -> dict:
+        """
+        Returns cached entry of a worksheet or None if there is no (valid) entry
+        :param path: str (path to workbook)
+        :param sheet: int (number of worksheet)
+        :return: dict
+        """
+        entry_path = self.entry_path(path, sheet)
+        try:
+            with open(entry_path, encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(entry_path)  # marks entry as recently used
+        except (OSError, ValueError):
+            return None
+        if entry.get('path') != os.path.realpath(path) or entry.get('sheet', 0) != sheet:
+            return None
+        return entry
+
+    def store(self, path: str, entry: dict, sheet: int = 0):
+        """
+        Stores entry of a worksheet and evicts least recently used entries if there are too many of them
+        :param path: str (path to workbook)
+        :param entry: dict
+        :param sheet: int (number of worksheet)
+        :return:
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        entry = dict(entry, path=os.path.realpath(path), sheet=sheet)
+        entry_path = self.entry_path(path, sheet)
+        with open(entry_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(entry_path + '.tmp', entry_path)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries above max_entries
+        :return:
+        """
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')]
+        if len(entries) > self.max_entries:
+            entries.sort(key=os.path.getmtime)
+            for entry_path in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.remove(entry_path)
+                except OSError:  # removed by another process
+                    pass
+
+
+# Export of cleaned data
+EXPORT_FIELDS = ('sheet', 'row', 'section', 'n', 'amount', 'tariff', 'period', 'period_value', 'unit', 'cost',
+                 'number_error', 'period_error', 'unit_error')  # fields of exported rows, see XLSXParser.export_rows
+EXPORT_TYPES = ('string', 'int64', 'int64', 'double', 'double', 'double', 'string', 'double', 'string', 'double',
+                'bool', 'bool', 'bool')  # types of EXPORT_FIELDS in parquet file
+EXPORT_FORMATS = ('csv', 'parquet')
+EXPORT_BATCH = 16384  # rows of one row group of parquet file, only one group is kept in memory while writing
+_pyarrow = False  # pyarrow module after the first import attempt (None if it is not installed), False - not tried yet
+
+
+def get_pyarrow():
+    """
+    Imports pyarrow on first call, pyarrow is optional and is needed only for export to parquet
+    :return: module or None
+    """
+    global _pyarrow
+    if _pyarrow is False:
+        try:
+            import pyarrow.parquet  # binds pyarrow with parquet submodule loaded
+        except ImportError:
+            pyarrow = None
+        _pyarrow = pyarrow
+    return _pyarrow
+
+
+def get_export_format(path: str) -> str:
+    """
+    Returns format of export file by its extension: 'parquet' for .parquet and .pq, 'csv' for everything else
+    :param path: str
+    :return: str
+    """
+    return 'parquet' if os.path.splitext(path)[1].lower() in ('.parquet', '.pq') else 'csv'
+
+
+def iter_batches(rows, size: int = EXPORT_BATCH):
+    """
+    Splits iterable of rows into lists of at most size rows, only one batch is kept in memory
+    :param rows: iterable
+    :param size: int
+    :return: generator (of lists)
+    """
+    rows = iter(rows)
+    return iter(lambda: list(islice(rows, size)), [])
+
+
+def write_csv(rows, path: str) -> int:
+    """
+    Writes rows (see EXPORT_FIELDS) to CSV file with header one by one, empty values are written as empty strings
+    :param rows: iterable (of tuples)
+    :param path: str
+    :return: int (number of written rows)
+    """
+    import csv
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_FIELDS)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+    return count
+
+
+def write_parquet(rows, path: str) -> int:
+    """
+    Writes rows (see EXPORT_FIELDS) to parquet file, every EXPORT_BATCH rows are written as a row group. Can raise
+    InputError if pyarrow is not installed
+    :param rows: iterable (of tuples)
+    :param path: str
+    :return: int (number of written rows)
+    """
+    pa = get_pyarrow()
+    if pa is None:
+        raise InputError('pyarrow is not installed, export to parquet is not available')
+    schema = pa.schema([(field, pa.type_for_alias(alias)) for field, alias in zip(EXPORT_FIELDS, EXPORT_TYPES)])
+    count = 0
+    with pa.parquet.ParquetWriter(path, schema) as writer:
+        for batch in iter_batches(rows):
+            writer.write_table(pa.Table.from_arrays([pa.array(column, type=field.type)
+                                                     for column, field in zip(zip(*batch), schema)], schema=schema))
+            count += len(batch)
+    return count
+
+
+def write_export(rows, path: str, export_format: str = None) -> int:
+    """
+    Writes rows to CSV or parquet file
+    :param rows: iterable (of tuples, see EXPORT_FIELDS)
+    :param path: str
+    :param export_format: str (one of EXPORT_FORMATS, by extension of path if not given)
+    :return: int (number of written rows)
+    """
+    if (export_format or get_export_format(path)) == 'parquet':
+        return write_parquet(rows, path)
+    return write_csv(rows, path)
+
+
+def merge_exports(paths: list, path: str, export_format: str = None):
+    """
+    Joins export files (of sheets) into one file in given order, CSV files are copied without their headers and row
+    groups of parquet files are copied one by one
+    :param paths: list (of export files written by write_export)
+    :param path: str (joined file)
+    :param export_format: str (one of EXPORT_FORMATS, by extension of path if not given)
+    :return:
+    """
+    if (export_format or get_export_format(path)) == 'parquet':
+        pa = get_pyarrow()
+        writer = None
+        try:
+            for part in paths:
+                source = pa.parquet.ParquetFile(part)
+                if writer is None:
+                    writer = pa.parquet.ParquetWriter(path, source.schema_arrow)
+                for i in range(source.num_row_groups):
+                    writer.write_table(source.read_row_group(i))
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            write_parquet((), path)  # no sheets, file with schema only
+        return
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(','.join(EXPORT_FIELDS) + '\r\n')  # the header as csv.writer writes it
+        for part in paths:
+            with open(part, encoding='utf-8', newline='') as source:
+                source.readline()
+                shutil.copyfileobj(source, f)
+
+
+FileResult = namedtuple('FileResult', ('path', 'is_modified', 'counters', 'error', 'summary'),
+                        defaults=(None, ))  # result of one file, summary is XLSXParser.summary() of the run
+
+
+class LazyFill:
+    """
+    Solid PatternFill of given color, created on first access so that openpyxl is not imported with the module
+    """
+
+    def __init__(self, color: str):
+        self.color = color
+        self.fill = None
+
+    def __get__(self, instance, owner):
+        if self.fill is None:
+            from openpyxl.styles import PatternFill
+            self.fill = PatternFill(start_color=self.color, end_color=self.color, fill_type='solid')
+        return self.fill
+
+
 # Main Class
 class XLSXParser:
     STARTING_ROW = 5  # the number of row after headers
+    FIRST_COLUMN = 4  # the number of the first column that may contain a checked header
+    SUBSECTION_AMOUNT = 961  # number of columns (starting from FIRST_COLUMN) that may contain checked headers
     PAGE_WITH_PERIOD_DATA = 1  # constant that stores number of page with period data
     PAGE_WITH_UNIT_DATA = 2  # constant that stores number of page with unit data
     NUM_SUBSECTIONS = ('Раз', 'Объем', 'Расценка', 'Годовая стоимость')  # needed sections for fix_num_column
@@ -167,51 +1310,301 @@ class XLSXParser:
                        'Осмотр раз в год. По итогам осмотра работы включаются в план текущего ремонта': 1,
                        'раз в год': 1
                        }
-    ENDING_ROW = 600
-    ending_row = 600  # number of row to watch in first column, will be changed in __init__ according to number of rows
+    PERIOD_KEYS = {normalize_key(period): number for period, number in PERIOD_TRANSFER.items()}  # normalized
+    NAME_COLUMN = 3  # column C with names of works, its non-empty cells are rows of data too
+    ending_row = STARTING_ROW - 1  # last row of data, found by get_columns as the last non-empty row of the sheet
+    read_only = False  # True while workbook is loaded in streaming mode by the pre-scan
+    cell_prefix = ''  # title of checked sheet written before cells in log, empty for the first sheet
     filepath = 'default_name.xlsx'  # in column
     _wb = None  # variable to store .xlsx Workbook
     _ws = None  # variable to store worksheet
-    red_fill = PatternFill(start_color='FFFF0000', end_color='FFFF0000', fill_type='solid')  # default error color (RED)
-    yellow_fill = PatternFill(start_color='FFFFF200', end_color='FFFFF200', fill_type='solid') # default color for
-    # marking period errors
-    sepia_fill = PatternFill(start_color='FFE3B778', end_color='FFE3B778', fill_type='solid')
+    red_fill = LazyFill('FFFF0000')  # default error color (RED)
+    yellow_fill = LazyFill('FFFFF200')  # default color for marking period errors
+    sepia_fill = LazyFill('FFE3B778')
     period_list = set()  # here will be stored period data from exel file
     unit_list = set()  # here will be stored unit data from exel file
+    period_index = None  # ReferenceIndex of period_list and unit_list
+    unit_index = None
     period_validator = None  # just initializing empty variables for better readability
     unit_validator = None
 
-    def __init__(self, path: str, is_validator: bool):
+    FILLS = ('red_fill', 'yellow_fill', 'sepia_fill')  # names of fills used to mark errors
+    VALIDATORS = ('period_validator', 'unit_validator')
+    ENGINES = ('openpyxl', 'patch')  # ways to save changes: openpyxl round-trip or direct patch of xml in archive
+    PRICE_MODES = ('formula', 'value', 'both')  # what to write to 'Годовая стоимость': formulas, computed numbers or
+    # formulas with computed cached results (the last is supported only by 'patch' engine)
+
+    def __init__(self, path: str, is_validator: bool, prescan: bool = False, dry_run: bool = False,
+                 report_path: str = None, engine: str = 'openpyxl', price_mode: str = 'formula',
+                 autocorrect: float = None, cache: FingerprintCache = None, output_path: str = None, sheet: int = 0,
+                 references: dict = None, export_path: str = None, export_format: str = None):
+        """
+        :param path: str (path to .xlsx file)
+        :param is_validator: bool (add drop-down validators to period and unit columns)
+        :param prescan: bool (first check the file in read-only mode and load it fully only if it has to be fixed,
+        faster for clean files and slower for files that have to be fixed, as they are read twice)
+        :param dry_run: bool (only find changes, do not apply and save them)
+        :param report_path: str (path to write JSON report of changes to)
+        :param engine: str ('openpyxl' to save whole workbook or 'patch' to rewrite only changed xml parts)
+        :param price_mode: str (one of PRICE_MODES)
+        :param autocorrect: float (period and unit errors are replaced with suggested value from reference list if
+        similarity is not less than this threshold, from 0 to 1; None - only suggest)
+        :param cache: FingerprintCache (if given, only rows changed since the last run are checked and the file is not
+        loaded at all if it was not changed)
+        :param output_path: str (path to save fixed workbook to, by default the file is fixed in place)
+        :param sheet: int (number of checked worksheet)
+        :param references: dict (number of reference page -> (values, last row), as returned by get_references(),
+        given to skip reading of reference pages when they are already read by another parser)
+        :param export_path: str (path to write cleaned rows of checked sheet to, see export_rows)
+        :param export_format: str (one of EXPORT_FORMATS, by extension of export_path if not given)
+        """
+        if engine not in self.ENGINES:
+            raise InputError('unknown save engine ' + engine)
+        if price_mode not in self.PRICE_MODES:
+            raise InputError('unknown price mode ' + price_mode)
+        if price_mode == 'both' and engine != 'patch':
+            raise InputError("openpyxl can not save cached results of formulas, price mode 'both' needs 'patch' engine")
+        if export_format is None and export_path is not None:
+            export_format = get_export_format(export_path)
+        if export_format is not None and export_format not in EXPORT_FORMATS:
+            raise InputError('unknown export format ' + export_format)
+        if export_format == 'parquet' and get_pyarrow() is None:
+            raise InputError('pyarrow is not installed, export to parquet is not available')
+        self.engine = engine
+        self.price_mode = price_mode
+        self.numbers = {}  # column number -> NumericColumn of normalized numbers of numeric column
+        self.corrected = {}  # column number -> CategoryColumn of period or unit column after corrections
+        self.errors = {}  # column number -> mask (bytearray) of cells with errors left after corrections
+        self.costs = {}  # column number of 'Годовая стоимость' -> NumericColumn of computed costs
+        self.sections = []  # header -> column number for every 'Годовая стоимость' and checked columns before it
+        self.export_path = export_path
+        self.export_format = export_format
+        self.autocorrect = autocorrect
+        self.cache = cache
+        self.skip_rows = set()  # rows not changed since the last run (according to cache), they are not checked
+        self._rows = []  # values and marks of checked cells by rows, used to store fingerprints in cache
+        self._cache_state = {}
+        self.cached_run = None  # entry of cache if the file was not changed since the last run, see find_cached_run
+        self._marks = {}  # (type, color) of fill -> name of marking fill with them, see get_mark
+        self.issues = {}  # row -> [column number, kind of error, suggestion, similarity] of errors found in the row
+        self.filepath = path  # path of checked file
+        self.output_path = path if output_path is None else output_path  # writes path to save
+        self.is_validator = is_validator
+        self.dry_run = dry_run
+        self.report_path = report_path
+        self.sheet = sheet
+        self.references = references
+        self.changes = ChangeSet()
+        self.sheet_changes = {sheet: self.changes}  # number of worksheet -> change set, saved together
+        self._values = {}  # column number -> values of fetched column, dropped when the column is checked
+        self._fill_codes = {}  # column number -> codes of fills of fetched cells (indexes of _fills), read-only mode
+        self._fills = []  # distinct fills of fetched cells
+        self._existing_validations = ()
+        self.counters = {'scanned': 0, 'fixed': 0, 'highlighted': 0, 'validator_ranges': 0, 'number': 0, 'period': 0,
+                         'unit': 0, 'skipped': 0, 'exported': 0}  # checked cells, fixed and highlighted cells, added
+        # validator ranges, found errors by type, rows skipped as not changed since the last run and exported rows
+        self.timers = {}  # phase -> seconds spent in it, accumulated over the run
+        self.load_error = None  # stores exception if file could not be loaded
+        from openpyxl.utils.exceptions import InvalidFileException
         try:
-            self.filepath = path  # writes path to save
-            self.is_validator = is_validator
-            self._wb = load_workbook(path)  # loads .xlsx file
-            self._wb.active = 0  # sets first sheet as active
-            self._ws = self._wb.active  # a reference to a worksheet
-            col = self._ws.iter_cols(min_col=3,
-                                     max_col=3,
-                                     min_row=self.STARTING_ROW,
-                                     max_row=self.ending_row,
-                                     values_only=True)
-            self.ending_row = get_end_row(next(col), self.STARTING_ROW)
+            if cache is not None:
+                with self.timer('lookup'):
+                    self.cached_run = self.find_cached_run()
+            if self.cached_run is None:
+                with self.timer('load'):
+                    self.load(read_only=prescan)
+        except (InvalidFileException, FileNotFoundError) as e:
+            self.load_error = e
+            logger.error('Error! Bad path! %s', e)
+
+    @contextmanager
+    def timer(self, phase: str):
+        """
+        Context manager that adds time spent in its block to self.timers[phase]
+        :param phase: str
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[phase] = self.timers.get(phase, 0.0) + time.perf_counter() - start
+
+    def load(self, read_only: bool):
+        """
+        Loads workbook (in streaming read-only mode or fully to be edited), reads reference pages and prepares
+        validators
+        :param read_only: bool
+        :return:
+        """
+        if self._wb is not None and self.read_only:
+            self._wb.close()  # read-only workbook keeps the file open
+        self.read_only = read_only
+        from openpyxl import load_workbook
+        self._wb = load_workbook(self.filepath, read_only=read_only)  # loads .xlsx file
+        if read_only:
+            for ws in self._wb.worksheets:  # in read-only mode size of sheets is taken from <dimension> as it is, a
+                ws.reset_dimensions()      # wrong one would hide rows, so sheets are read up to their real end
+        self._wb.active = self.sheet  # sets checked sheet as active
+        self._ws = self._wb.active  # a reference to a worksheet
+        self.cell_prefix = '' if self.sheet == 0 else quote_string(self._ws.title) + '!'  # cells of other sheets are
+        # reported with title of the sheet
+        self.reference_ends = {}  # number of reference page -> last row of its list
+        if self.references is None:
             self.period_list = self.get_values(self.PAGE_WITH_PERIOD_DATA)
             self.unit_list = self.get_values(self.PAGE_WITH_UNIT_DATA)
-            # print(self.ending_row)
-            if self.is_validator:
-                self.period_validator = self.get_validator(self.PAGE_WITH_PERIOD_DATA)
-                self.unit_validator = self.get_validator(self.PAGE_WITH_UNIT_DATA)
-                self.period_validator.errorTitle = self.unit_validator.errorTitle = 'Недопустимое значение'
-                self.period_validator.errorTitle = self.unit_validator.errorTitle =\
-                    'Данное значение отсутствует в списке'
-                self.period_validator.promptTitle = 'Выбор видов периодичности'
-                self.period_validator.prompt = 'Пожалуйста выберите вид периодичности из списка'
-                self.unit_validator.promptTitle = 'Выбор единиц измерения'
-                self.unit_validator.prompt = 'Пожалуйста выберите единицы измерения из списка'
-                self._ws.add_data_validation(self.period_validator)
-                self._ws.add_data_validation(self.unit_validator)
-
-        except (InvalidFileException, FileNotFoundError):
-            print("Error! Bad path!")
+        else:
+            self.reference_ends = {page: end_row for page, (values, end_row) in self.references.items()}
+            self.period_list = self.references[self.PAGE_WITH_PERIOD_DATA][0]
+            self.unit_list = self.references[self.PAGE_WITH_UNIT_DATA][0]
+        self.period_index = ReferenceIndex(self.period_list or ())
+        self.unit_index = ReferenceIndex(self.unit_list or ())
+        if self.is_validator:
+            if read_only:  # openpyxl does not read validations in read-only mode, they are read from worksheet xml
+                with zipfile.ZipFile(self.filepath) as archive, \
+                        archive.open(get_sheet_paths(archive)[self.sheet]) as src:
+                    self._existing_validations = read_data_validations(src)
+            else:
+                self._existing_validations = self._ws.data_validations.dataValidation
+            self.period_validator = self.get_validator(self.PAGE_WITH_PERIOD_DATA)
+            self.unit_validator = self.get_validator(self.PAGE_WITH_UNIT_DATA)
+            self.period_validator.errorTitle = self.unit_validator.errorTitle = 'Недопустимое значение'
+            self.period_validator.errorTitle = self.unit_validator.errorTitle =\
+                'Данное значение отсутствует в списке'
+            self.period_validator.promptTitle = 'Выбор видов периодичности'
+            self.period_validator.prompt = 'Пожалуйста выберите вид периодичности из списка'
+            self.unit_validator.promptTitle = 'Выбор единиц измерения'
+            self.unit_validator.prompt = 'Пожалуйста выберите единицы измерения из списка'
+
+    def get_value(self, row: int, col_num: int):
+        """
+        Returns value of a cell, in read-only mode only values of fetched columns which are being checked are available
+        :param row: int
+        :param col_num: int
+        :return: value of the cell
+        """
+        if self.read_only:
+            return self._values[col_num][row - self.STARTING_ROW]
+        return self._ws.cell(row=row, column=col_num).value
+
+    def get_fill(self, row: int, col_num: int):
+        """
+        Returns fill of a cell, in read-only mode it is the fill stored by get_columns (None for empty cells)
+        :param row: int
+        :param col_num: int
+        :return: PatternFill or None
+        """
+        if self.read_only:
+            return self._fills[self._fill_codes[col_num][row - self.STARTING_ROW]]
+        return self._ws.cell(row=row, column=col_num).fill
+
+    def set_value(self, row: int, col_num: int, value) -> bool:
+        """
+        Stores new value of a cell in change set if it differs from current one, returns status is_modified
+        :param row: int
+        :param col_num: int
+        :param value: new value
+        :return: bool
+        """
+        return self.changes.add_value(row, col_num, self.get_value(row, col_num), value)
+
+    def set_fill(self, row: int, col_num: int, fill: str):
+        """
+        Stores fill of a cell in change set
+        :param row: int
+        :param col_num: int
+        :param fill: str (name of fill attribute, e.g. 'red_fill')
+        :return:
+        """
+        self.changes.add_fill(row, col_num, fill)
+        self.counters['highlighted'] += 1
+
+    def add_error(self, row: int, col_num: int, kind: str, suggestion=None, similarity: float = None):
+        """
+        Counts error left in a cell and stores suggested value for it in change set, errors are kept by rows to be
+        stored in cache and reported again for rows that are not checked next time
+        :param row: int
+        :param col_num: int
+        :param kind: str ('number', 'period' or 'unit')
+        :param suggestion: value from reference list (None if there is no suggestion)
+        :param similarity: float
+        :return:
+        """
+        self.counters[kind] += 1
+        if suggestion is not None:
+            self.changes.suggestions[(row, col_num)] = (suggestion, similarity)
+        self.issues.setdefault(row, []).append([col_num, kind, suggestion, similarity])
+
+    def get_mark(self, row: int, col_num: int) -> str:
+        """
+        Returns name of fill (one of FILLS) the cell is marked with or empty string, fills are told apart by type and
+        color and every distinct pair of them is compared once
+        :param row: int
+        :param col_num: int
+        :return: str
+        """
+        fill = self.get_fill(row, col_num)
+        key = (None, None) if fill is None else (fill.fill_type, fill.fgColor.rgb)
+        mark = self._marks.get(key)
+        if mark is None:
+            mark = self._marks[key] = next((name for name in self.FILLS
+                                            if key == (getattr(self, name).fill_type, getattr(self, name).fgColor.rgb)),
+                                           '')
+        return mark
+
+    def add_validator_range(self, validator: str, cell_range: str) -> bool:
+        """
+        Stores range of validator in change set if the worksheet does not have the same validator for this range yet,
+        returns status is_modified. Existing validation of the same type in the column of the range is updated instead
+        of adding another one: its formula is replaced (reference list was changed) and its ranges inside the new one
+        are replaced with it (data grew)
+        :param validator: str (name of validator attribute, e.g. 'period_validator')
+        :param cell_range: str (range inside one column)
+        :return: bool
+        """
+        from openpyxl.worksheet.cell_range import CellRange, MultiCellRange
+        dv = getattr(self, validator)
+        col_num = CellRange(cell_range).min_col
+        for i, existing in enumerate(self._existing_validations):
+            sqref = MultiCellRange(self.changes.validator_updates.get(i, (None, str(existing.sqref)))[1])
+            if existing.type != dv.type or not any(r.min_col <= col_num <= r.max_col for r in sqref.ranges):
+                continue
+            if existing.formula1 == dv.formula1 and cell_range in sqref:
+                return False
+            if cell_range not in sqref:
+                sqref = ' '.join([str(r) for r in sqref.ranges if not r.issubset(CellRange(cell_range))] +
+                                 [cell_range])
+            self.changes.update_validator(i, validator, str(sqref))
+            self.counters['validator_ranges'] += 1
+            return True
+        self.changes.add_validator(validator, cell_range)
+        self.counters['validator_ranges'] += 1
+        return True
+
+    def apply_changes(self, changes: ChangeSet, ws=None):
+        """
+        Writes change set to the worksheet, workbook must be loaded fully (not in read-only mode)
+        :param changes: ChangeSet
+        :param ws: Worksheet (checked worksheet by default)
+        :return:
+        """
+        if self.read_only:
+            raise NonePointer('workbook is loaded in read-only mode')
+        from openpyxl.worksheet.datavalidation import DataValidation
+        ws = self._ws if ws is None else ws
+        for (row, col_num), (old, new) in changes.values.items():
+            ws.cell(row=row, column=col_num, value=new)
+        for (row, col_num), fill in changes.fills.items():
+            ws.cell(row=row, column=col_num).fill = getattr(self, fill)
+        for validator, ranges in changes.validators.items():
+            dv = DataValidation.from_tree(getattr(self, validator).to_tree())  # copy, every sheet needs its own one
+            for cell_range in ranges:
+                dv.add(cell_range)
+            ws.add_data_validation(dv)
+        for index, (validator, sqref) in changes.validator_updates.items():
+            dv = ws.data_validations.dataValidation[index]
+            dv.formula1 = getattr(self, validator).formula1
+            dv.sqref = sqref
 
     def fix_num_column(self, col: tuple, col_num: int) -> bool:
         """
@@ -223,31 +1616,27 @@ class XLSXParser:
         """
         is_modified = False
         if self._ws is not None:  # check is worksheet exists
-            row_counter = self.STARTING_ROW  # initializing counter on the first row after header
-            for cel in col:
-                if cel is not None:  # checking cell conditions
-                    is_num, is_changed, num = get_number(cel)
-                    if is_changed:
+            is_fixed, is_error, numbers = normalize_num_column(col)
+            self.numbers[col_num] = numbers  # kept for computation of 'Годовая стоимость' and export
+            self.errors[col_num] = is_error
+            for i, (num, is_num) in enumerate(zip(numbers.values, numbers.valid)):
+                row_counter = i + self.STARTING_ROW  # rows start after header
+                if row_counter in self.skip_rows:
+                    continue
+                if is_num:  # number, we assign the value to fix possible error when number has wrong
+                    if is_fixed[i]:  # separator or contains many signs after comma
+                        self.counters['fixed'] += 1
+                    if self.set_value(row_counter, col_num, num):
                         is_modified = True  # if any cell should be changed return function modified status
-                    if is_num:  # true
-                        # print(str(cel) + ' is a number')
-                        if is_integer(num):
-                            # print(str(cel) + ' is integer')
-                            self._ws.cell(row=row_counter, column=col_num, value=num)  # if it is int - do nothing
-                        else:  # but we still assign the value to fix possible error when number has wrong separator and
-                            # print(str(cel) + ' is float')
-                            if precision_num(num) > 5:  # get_number() function fixes this problem
-                                self._ws.cell(row=row_counter, column=col_num, value=trunc(num, 5))  # if it is float
-                            else:                                   # and contains many signs after comma trunc value
-                                self._ws.cell(row=row_counter, column=col_num, value=num)  # else do not touch
-                    else:
-                        if not is_formula(cel):
-                            if self._ws.cell(row=row_counter, column=col_num).fill != self.red_fill:
-                                print(str(get_column_letter(col_num)) + str(row_counter) +
-                                      ' ячейка содержит ошибку с числом. Помечено красным')
-                                self._ws.cell(row=row_counter, column=col_num).fill = self.red_fill  # and if it is not
-                                is_modified = True
-                    row_counter += 1  # a number at all mark it with marking color.
+                elif is_error[i]:  # not a number and not a formula
+                    self.add_error(row_counter, col_num, 'number')
+                    if self.get_fill(row_counter, col_num) != self.red_fill:  # mark it with marking color
+                        logger.warning('%s%s%s ячейка содержит ошибку с числом. Помечено красным', self.cell_prefix,
+                                       get_column_letter(col_num), row_counter,
+                                       extra={'cell': self.cell_prefix + get_column_letter(col_num) + str(row_counter),
+                                              'kind': 'number'})
+                        self.set_fill(row_counter, col_num, 'red_fill')
+                        is_modified = True
         else:
             raise NonePointer('worksheet is not defined')
         return is_modified
@@ -255,7 +1644,10 @@ class XLSXParser:
     def fix_other_column(self, col: tuple, col_num: int, header: str) -> bool:
         """
         Fixes period and unit column, header of the column should be passed to function to choose needed checklist,
-        returns status is_modified. Can raise UndefinedHeaderError if header is wrong
+        returns status is_modified. Values that differ from reference list only by whitespace or 'ё' are replaced with
+        value from the list, for other errors (case included) the closest value is suggested (and applied if
+        autocorrect is set).
+        Can raise UndefinedHeaderError if header is wrong
         :param col: tuple
         :param col_num: int
         :param header: str
@@ -263,103 +1655,502 @@ class XLSXParser:
         """
         is_modified = False
         if self._ws is not None:
-            checklist = set()
+            checklist = None
             highlight = None
             validator = None
             if header in self.PERIOD_SUBSECTIONS:
-                checklist = self.period_list
-                highlight = self.yellow_fill
-                validator = self.period_validator
+                checklist = self.period_index
+                highlight = 'yellow_fill'
+                validator = 'period_validator'
+                counter = 'period'
+                message = 'ячейка содержит ошибку вида периодичности. Помечено желтым'
             elif header in self.UNIT_SUBSECTIONS:
-                checklist = self.unit_list
-                highlight = self.sepia_fill
-                validator = self.unit_validator
+                checklist = self.unit_index
+                highlight = 'sepia_fill'
+                validator = 'unit_validator'
+                counter = 'unit'
+                message = 'ячейка содержит ошибку единицы измерения. Помечено цветом сепии'
             else:
                 raise UndefinedHeaderError('header does not exist in any of given subsections')
-            row_counter = self.STARTING_ROW
-            for cel in col:
-                if cel not in checklist and cel is not None and cel != '':
-                    if self._ws.cell(row_counter, col_num).fill != highlight:  # if not yet marked
-                        if checklist is self.unit_list:
-                            print(str(get_column_letter(col_num)) + str(row_counter) +
-                                  ' ячейка содержит ошибку единицы измерения. Помечено цветом сепии')
-                        else:
-                            print(str(get_column_letter(col_num)) + str(row_counter) +
-                                  ' ячейка содержит ошибку вида периодичности. Помечено желтым')
-                        self._ws.cell(row_counter, col_num).fill = highlight
-                        is_modified = True  # if any cell highlighted (changed) - change modify status
-                row_counter += 1
-            if self.is_validator:
-                validator.add(str(get_column_letter(col_num)) + str(self.STARTING_ROW) + ':'
-                              + str(get_column_letter(col_num)) + str(self.ENDING_ROW))
+            corrected = CategoryColumn.from_values(col, checklist.values)  # codes below size are values of the list
+            size = len(checklist.values)
+            reference_codes = {value: code for code, value in enumerate(checklist.values)}
+            decisions = {}  # code of value not from the list -> (value of the list, similarity, is it replaced)
+            codes = corrected.codes
+            for i, code in enumerate(codes):
+                if code < size:  # empty cell or value of the list
+                    continue
+                row_counter = i + self.STARTING_ROW
+                if row_counter in self.skip_rows:
+                    continue
+                if code not in decisions:  # every distinct value is looked up in the list once
+                    cel = corrected.categories[code]
+                    value = checklist.find(cel)
+                    if value is not None:  # differs only by whitespace or 'ё' - always replaced
+                        decisions[code] = (value, 1.0, True)
+                    else:  # even suggestion with similarity 1.0 is not the same value, it is applied only on demand
+                        value, similarity = checklist.suggest(cel)
+                        decisions[code] = (value, similarity, self.autocorrect is not None and value is not None and
+                                           similarity >= self.autocorrect)
+                value, similarity, is_replaced = decisions[code]
+                if is_replaced:
+                    codes[i] = reference_codes[value]
+                    self.set_value(row_counter, col_num, value)
+                    self.counters['fixed'] += 1
+                    is_modified = True
+                    continue
+                self.add_error(row_counter, col_num, counter, value, similarity)
+                if self.get_fill(row_counter, col_num) != getattr(self, highlight):  # if not yet marked
+                    logger.warning('%s%s%s %s%s', self.cell_prefix, get_column_letter(col_num), row_counter, message,
+                                   '' if value is None else ', возможно имелось в виду ' + quote_string(value),
+                                   extra={'cell': self.cell_prefix + get_column_letter(col_num) + str(row_counter),
+                                          'kind': counter, 'suggestion': value})
+                    self.set_fill(row_counter, col_num, highlight)
+                    is_modified = True  # if any cell highlighted (changed) - change modify status
+            self.corrected[col_num] = corrected
+            self.errors[col_num] = bytearray(code >= size for code in codes)  # values left out of the list
+            if self.is_validator and self.ending_row >= self.STARTING_ROW:
+                if self.add_validator_range(validator, str(get_column_letter(col_num)) + str(self.STARTING_ROW) + ':'
+                                            + str(get_column_letter(col_num)) + str(self.ending_row)):
+                    is_modified = True  # new validator range should be saved too
         else:
             raise NonePointer('worksheet is not defined')
         return is_modified
 
-    def find_errors(self):
+    def find_errors(self) -> bool:
         """
         this method parses the table and fixes the errors with fix_num_column and fix_other_column. Also
-        it checks value in 'Годовая стоимость' and replaces it if it contains error
-        :return:
+        it checks value in 'Годовая стоимость' and replaces it if it contains error. If workbook was loaded in
+        read-only mode it is checked first and loaded fully (to be fixed and saved) only when something has to be
+        changed, returns status is_modified
+        :return: bool
         """
-        if self._ws is not None:
-            is_num_modified = False
-            is_other_modified = False
-            col_counter = 4
-            subsection_amount = 961
-            n = []
-            periodicity = []
-            amount = []
-            tariff = []
-            print('Если таблица не содержит ошибок или они уже были помечены - ничего не будет выведено в лог'
-                  ', иначе будут выведены номера ячеек с ошибками, типом ошибки и помеченным цветом')
-            for i in range(subsection_amount):
-                header = self._ws.cell(column=col_counter, row=self.STARTING_ROW - 1).value
-                col = self._ws.iter_cols(min_col=col_counter,
-                                         max_col=col_counter,
-                                         min_row=self.STARTING_ROW,
-                                         max_row=self.ending_row,
-                                         values_only=True)
-                col_tup = next(col)
-                # print(self._ws.cell(column=col_counter, row=self.STARTING_ROW - 1).value)
-                if header in self.NUM_SUBSECTIONS:
-                    tmp = self.fix_num_column(col_tup, col_counter)
-                    if tmp:
-                        is_num_modified = True
-                    # print(col_tup)
-                elif header in self.UNIT_SUBSECTIONS or header in self.PERIOD_SUBSECTIONS:
-                    tmp = self.fix_other_column(col_tup, col_counter, header)
-                    if tmp:
-                        is_other_modified = True
-                print(header)
-                if header == self.NUM_SUBSECTIONS[0]:
-                    n = get_column_letter(col_counter)
-                    print(n)
-                if header == self.PERIOD_SUBSECTIONS[0]:
-                    periodicity = self.trans_period(col_tup)
-                    print(periodicity)
-                if header == self.NUM_SUBSECTIONS[1]:
-                    amount = get_column_letter(col_counter)
-                    print(amount)
-                if header == self.NUM_SUBSECTIONS[2]:
-                    tariff = get_column_letter(col_counter)
-                    print(tariff)
-                if header == self.NUM_SUBSECTIONS[3] and len([i for i in n if i is not None]) > 0 and \
-                        len([i for i in periodicity if i is not None]) > 0 and \
-                        len([i for i in amount if i is not None]) > 0 and \
-                        len([i for i in tariff if i is not None]) > 0:
-                    price = self.form_price(periodicity, n, amount, tariff)
-                    self.assign_col(price, col_counter)
-                col_counter += 1
-            # print(is_num_modified, is_other_modified)
-            if is_num_modified or is_other_modified or self.is_validator:
-                self._wb.save(self.filepath)
+        if self._ws is not None or self.cached_run is not None:
+            logger.info('Если таблица не содержит ошибок или они уже были помечены - ничего не будет выведено в лог'
+                        ', иначе будут выведены номера ячеек с ошибками, типом ошибки и помеченным цветом')
+            with self.timer('total'):
+                fingerprints = {}
+                if self.cached_run is not None:
+                    logger.info('%s: файл не изменился с прошлого запуска, ошибки взяты из кэша', self.filepath)
+                    self.replay_cached_run()
+                    is_modified = False
+                else:
+                    is_modified = self.check_table()
+                    if self.export_path is not None:
+                        with self.timer('export'):
+                            self.export()
+                    if self.cache is not None and not self.dry_run:
+                        with self.timer('cache'):
+                            fingerprints[self.sheet] = self.get_fingerprints()
+                self.finish(is_modified, fingerprints)
+            logger.info('%s: %s', self.filepath, ', '.join(key + '=' + str(value)
+                                                          for key, value in self.counters.items()))
+            return is_modified
         else:
             raise NonePointer('Worksheet is not defined')
 
+    def find_errors_in_sheets(self, workers: int = None) -> bool:
+        """
+        Checks all data sheets of the workbook (see get_data_sheets) in a pool of processes, reference lists are read
+        once and passed to every process. Change sets of all sheets are saved at once, returns status is_modified.
+        Timers of phases are summed over sheets, 'sheets' is wall time of the whole check. Every process exports its
+        sheet to a temporary file, the files are joined in order of sheets
+        :param workers: int (number of processes, number of CPUs by default, 1 - check sheets in this process)
+        :return: bool
+        """
+        if self._wb is None and self.cached_run is not None:  # first sheet was not changed, but others may be
+            with self.timer('load'):
+                self.load(read_only=True)
+        if self._wb is None:
+            raise NonePointer('Workbook is not defined')
+        with self.timer('total'):
+            sheets = self.get_data_sheets()
+            options = {'engine': self.engine, 'price_mode': self.price_mode, 'autocorrect': self.autocorrect,
+                       'cache': self.cache, 'export_format': self.export_format}
+            export_dir = None
+            if self.export_path is not None:
+                export_dir = tempfile.mkdtemp(prefix='.export-', dir=os.path.dirname(os.path.abspath(self.export_path)))
+            args = (self.filepath, self.is_validator, self.get_references(), options,
+                    self.cache is not None and not self.dry_run, export_dir)
+            try:
+                with self.timer('sheets'):
+                    if workers == 1 or len(sheets) < 2:
+                        results = [check_sheet(*args, sheet) for sheet in sheets]
+                    else:
+                        from concurrent.futures import ProcessPoolExecutor
+                        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(sheets))) as pool:
+                            results = list(pool.map(partial(check_sheet, *args), sheets))
+                if export_dir is not None:
+                    with self.timer('export'):
+                        merge_exports([os.path.join(export_dir, str(sheet)) for sheet in sheets], self.export_path,
+                                      self.export_format)
+            finally:
+                if export_dir is not None:
+                    shutil.rmtree(export_dir, ignore_errors=True)
+            self.sheet_changes = {}
+            self.counters = dict.fromkeys(self.counters, 0)
+            fingerprints = {}
+            for sheet, (changes, counters, timers, entry) in zip(sheets, results):
+                self.sheet_changes[sheet] = changes
+                for key, value in counters.items():
+                    self.counters[key] += value
+                for phase, seconds in timers.items():
+                    self.timers[phase] = self.timers.get(phase, 0.0) + seconds
+                if entry is not None:
+                    fingerprints[sheet] = entry
+            self.changes = self.sheet_changes.get(self.sheet, ChangeSet())
+            is_modified = any(self.sheet_changes.values())
+            self.finish(is_modified, fingerprints)
+        logger.info('%s (%s): %s', self.filepath, len(sheets), ', '.join(key + '=' + str(value)
+                                                                         for key, value in self.counters.items()))
+        return is_modified
+
+    def finish(self, is_modified: bool, fingerprints: dict):
+        """
+        Writes report, saves change sets of all checked sheets (or copies clean file to output) and stores fingerprints
+        of checked sheets in cache together with state of the saved file
+        :param is_modified: bool
+        :param fingerprints: dict (number of sheet -> entry of cache from get_fingerprints)
+        :return:
+        """
+        if self.report_path is not None:
+            with self.timer('report'):
+                self.write_report()
+        if is_modified and not self.dry_run:
+            if self.read_only and self.engine == 'openpyxl':  # pre-scanned file has to be fixed, it is loaded fully
+                with self.timer('reload'):                    # now and timed apart from saving
+                    self.load(read_only=False)
+            with self.timer('save'):
+                self.save()
+        else:
+            if self.read_only:
+                self._wb.close()  # file is clean (or dry run), no need to load it fully and save
+            if not self.dry_run and self.output_path != self.filepath:
+                shutil.copyfile(self.filepath, self.output_path)  # clean file is written to output as is
+        # if fixed copy is saved to another file, input stays unfixed and its rows are checked next time again
+        if fingerprints and (self.output_path == self.filepath or not is_modified):
+            with self.timer('cache'):
+                state = get_file_state(self.filepath)
+                for sheet, entry in fingerprints.items():
+                    self.cache.store(self.filepath, dict(entry, file=state), sheet)
+
+    def write_report(self):
+        """
+        Writes JSON report of changes to report_path, when several sheets are checked changes are grouped by titles of
+        sheets
+        :return:
+        """
+        if list(self.sheet_changes) == [self.sheet]:
+            self.changes.to_json(self.report_path)
+            return
+        titles = self._wb.sheetnames
+        report = {titles[sheet]: changes.to_dict() for sheet, changes in sorted(self.sheet_changes.items())}
+        with open(self.report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+
+    def save(self):
+        """
+        Saves change sets to the file with chosen engine, if direct patch of xml fails workbook is saved by openpyxl
+        :return:
+        """
+        changes = {sheet: sheet_changes for sheet, sheet_changes in self.sheet_changes.items() if sheet_changes}
+        if self.engine == 'patch':
+            if self.read_only:
+                self._wb.close()  # archive is opened again by patch_workbook
+            try:
+                patch_workbook(self.filepath, self.output_path, changes,
+                               {fill: getattr(self, fill) for fill in self.FILLS},
+                               {validator: getattr(self, validator) for validator in self.VALIDATORS})
+                return
+            except PatchError as e:
+                logger.warning('Не удалось сохранить изменения напрямую в xml (%s), файл будет сохранен через openpyxl',
+                               e)
+        if self.read_only or self.engine == 'patch':  # the file has to be fixed, so it is loaded fully now
+            self.load(read_only=False)
+        for sheet, sheet_changes in changes.items():
+            self.apply_changes(sheet_changes, self._wb.worksheets[sheet])
+        self._wb.save(self.output_path)
+
+    def summary(self) -> dict:
+        """
+        Returns summary of the run: options, counters, time of phases (in seconds) and number of changes by kind
+        :return: dict
+        """
+        change_sets = self.sheet_changes.values()
+        return {'file': self.filepath,
+                'output': self.output_path,
+                'export': self.export_path,
+                'sheets': sorted(self.sheet_changes),
+                'engine': self.engine,
+                'price_mode': self.price_mode,
+                'dry_run': self.dry_run,
+                'error': None if self.load_error is None else repr(self.load_error),
+                'is_modified': any(change_sets),
+                'counters': dict(self.counters),
+                'timers': {phase: round(seconds, 6) for phase, seconds in self.timers.items()},
+                'changes': {'values': sum(len(changes.values) for changes in change_sets),
+                            'fills': sum(len(changes.fills) for changes in change_sets),
+                            'validators': sum(len(ranges) for changes in change_sets
+                                              for ranges in changes.validators.values()),
+                            'suggestions': sum(len(changes.suggestions) for changes in change_sets)}}
+
+    def summary_json(self, path: str = None) -> str:
+        """
+        Returns summary of the run as JSON and writes it to a file if path is given
+        :param path: str
+        :return: str
+        """
+        summary = json.dumps(self.summary(), ensure_ascii=False, indent=2)
+        if path is not None:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(summary)
+        return summary
+
+    def check_table(self) -> bool:
+        """
+        Checks all checked columns of the worksheet and stores found fixes in change set (self.changes), returns
+        status is_modified
+        :return: bool
+        """
+        self.changes = ChangeSet()  # change set, counters and timers of the check are filled again on every check
+        self.sheet_changes = {self.sheet: self.changes}
+        self.counters = dict.fromkeys(self.counters, 0)
+        self.timers = {phase: self.timers[phase] for phase in ('lookup', 'load') if phase in self.timers}
+        self.numbers = {}
+        self.corrected = {}
+        self.issues = {}
+        self.errors = {}
+        self.costs = {}
+        self.sections = []
+        section = {}  # header -> number of the last column with it
+        n = amount = tariff = None  # numbers of columns needed to form 'Годовая стоимость'
+        periodicity = None
+        with self.timer('fetch'):
+            header_index = self.get_header_index()
+            headers = {col_num: header for header, col_nums in header_index.items() for col_num in col_nums}
+            columns = self.get_columns(tuple(headers))
+        if self.cache is not None:
+            with self.timer('cache'):
+                self.find_unchanged_rows(headers, columns)
+        for col_counter in sorted(headers):  # columns are visited left to right as 'Годовая стоимость' needs
+            header = headers[col_counter]    # columns before it
+            col_tup = columns[col_counter]
+            logger.debug('%s: %s', get_column_letter(col_counter), header)
+            section[header] = col_counter
+            if header in self.NUM_SUBSECTIONS:
+                with self.timer('numbers'):
+                    self.fix_num_column(col_tup, col_counter)
+            elif header in self.UNIT_SUBSECTIONS or header in self.PERIOD_SUBSECTIONS:
+                with self.timer('references'):
+                    self.fix_other_column(col_tup, col_counter, header)
+            self.counters['scanned'] += len(col_tup) - len(self.skip_rows)
+            if header == self.NUM_SUBSECTIONS[0]:
+                n = col_counter
+            if header == self.PERIOD_SUBSECTIONS[0]:
+                periodicity = self.trans_period(self.corrected[col_counter])
+                logger.debug('periodicity: %s', periodicity)
+            if header == self.NUM_SUBSECTIONS[1]:
+                amount = col_counter
+            if header == self.NUM_SUBSECTIONS[2]:
+                tariff = col_counter
+            if header == self.NUM_SUBSECTIONS[3] and None not in (n, amount, tariff, periodicity) and \
+                    any(periodicity.valid):
+                with self.timer('price'):
+                    cost = self.compute_price(periodicity, self.numbers[n], self.numbers[amount], self.numbers[tariff])
+                    self.costs[col_counter] = cost
+                    if self.price_mode == 'value':
+                        self.assign_col(tuple('#ERR' if value is None else round_num(value) for value in cost),
+                                        col_counter)
+                    else:
+                        price = self.form_price(periodicity, (self.numbers[n], self.numbers[amount],
+                                                              self.numbers[tariff]),
+                                                tuple(get_column_letter(col_num) for col_num in (n, amount, tariff)))
+                        self.assign_col(price, col_counter, cost if self.price_mode == 'both' else None)
+            if header == self.NUM_SUBSECTIONS[3]:
+                self.sections.append(dict(section))
+            del columns[col_counter]  # only compact numbers and categories are kept after the column is checked
+            self._fill_codes.pop(col_counter, None)
+        if section and not self.sections:  # sheet without 'Годовая стоимость' is exported as one section
+            self.sections.append(section)
+        return bool(self.changes)
+
+    def find_unchanged_rows(self, headers: dict, columns: dict):
+        """
+        Compares fingerprints of rows (values and marking fills of checked cells) with the ones stored in cache after
+        the last run and fills skip_rows, errors left in skipped rows are counted and reported again from cache. All
+        rows are checked if reference lists, headers or options were changed
+        :param headers: dict (column number -> header)
+        :param columns: dict (column number -> tuple of values)
+        :return:
+        """
+        col_order = sorted(headers)
+        self._marks = {}
+        self._rows = [list(row) + [self.get_mark(row_num, col_num) for col_num in col_order]
+                      for row_num, row in enumerate(zip(*(columns[col_num] for col_num in col_order)),
+                                                    self.STARTING_ROW)]
+        self._cache_state = {'references': fingerprint(tuple(self.period_list or ()) + tuple(self.unit_list or ())),
+                             'headers': [[col_num, headers[col_num]] for col_num in col_order],
+                             'options': self.get_options_fingerprint()}
+        self.skip_rows = set()
+        entry = self.cache.load(self.filepath, self.sheet)
+        if entry is not None and all(entry.get(key) == value for key, value in self._cache_state.items()):
+            self.skip_rows = {row for row, (row_values, old) in enumerate(zip(self._rows, entry.get('rows', ())),
+                                                                          self.STARTING_ROW)
+                              if fingerprint(row_values) == old}
+            issues = entry.get('issues', {})
+            for row in sorted(self.skip_rows):
+                for col_num, kind, suggestion, similarity in issues.get(str(row), ()):
+                    self.add_error(row, col_num, kind, suggestion, similarity)
+        self.counters['skipped'] = len(self.skip_rows)
+
+    def get_options_fingerprint(self) -> str:
+        """
+        Returns fingerprint of options that change results of the check, stored in cache
+        :return: str
+        """
+        return fingerprint((self.is_validator, self.price_mode, self.autocorrect))
+
+    def find_cached_run(self) -> dict:
+        """
+        Returns entry of cache stored by the last run if the file was not changed since then and options are the same,
+        such a run is replayed from cache without loading the workbook (see replay_cached_run). Export needs the data,
+        so the file is always checked for it
+        :return: dict (None if the file has to be checked)
+        """
+        if self.cache is None or self.export_path is not None:
+            return None
+        entry = self.cache.load(self.filepath, self.sheet)
+        if entry is None or entry.get('options') != self.get_options_fingerprint():
+            return None
+        try:
+            return entry if is_file_unchanged(self.filepath, entry.get('file')) else None
+        except OSError:  # file is missing, it is reported by load
+            return None
+
+    def replay_cached_run(self):
+        """
+        Fills counters and errors from cached_run as a check of the unchanged file would do: all rows are skipped and
+        errors left in them are reported again, change set stays empty
+        :return:
+        """
+        self.changes = ChangeSet()
+        self.sheet_changes = {self.sheet: self.changes}
+        self.counters = dict.fromkeys(self.counters, 0)
+        self.issues = {}
+        rows = self.cached_run.get('rows', ())
+        self.ending_row = self.STARTING_ROW + len(rows) - 1
+        self.counters['skipped'] = len(rows)
+        for row, issues in sorted((int(row), issues) for row, issues in self.cached_run.get('issues', {}).items()):
+            for col_num, kind, suggestion, similarity in issues:
+                self.add_error(row, col_num, kind, suggestion, similarity)
+
+    def get_fingerprints(self) -> dict:
+        """
+        Returns entry of cache with fingerprints of rows as they are after applying change set and errors left in them
+        :return: dict
+        """
+        col_order = [col_num for col_num, header in self._cache_state['headers']]
+        for (row, col_num), (old, new) in self.changes.values.items():
+            self._rows[row - self.STARTING_ROW][col_order.index(col_num)] = new
+        for (row, col_num), fill in self.changes.fills.items():
+            self._rows[row - self.STARTING_ROW][len(col_order) + col_order.index(col_num)] = fill
+        return dict(self._cache_state, rows=[fingerprint(row) for row in self._rows],
+                    issues={str(row): issues for row, issues in self.issues.items()})
+
+    def get_header_index(self, ws=None) -> dict:
+        """
+        Reads the header row (the one before STARTING_ROW) once and maps every checked header to the list of numbers of
+        columns it is found in
+        :param ws: Worksheet (checked worksheet by default)
+        :return: dict (header -> list of column numbers)
+        """
+        checked = self.NUM_SUBSECTIONS + self.PERIOD_SUBSECTIONS + self.UNIT_SUBSECTIONS
+        rows = (self._ws if ws is None else ws).iter_rows(min_row=self.STARTING_ROW - 1,
+                                  max_row=self.STARTING_ROW - 1,
+                                  min_col=self.FIRST_COLUMN,
+                                  max_col=self.FIRST_COLUMN + self.SUBSECTION_AMOUNT - 1,
+                                  values_only=True)
+        index = {}
+        for col_num, header in enumerate(next(rows, ()), self.FIRST_COLUMN):
+            if header in checked:
+                index.setdefault(header, []).append(col_num)
+        return index
+
+    def get_data_sheets(self) -> list:
+        """
+        Returns numbers of data sheets: all sheets except reference pages that have at least one checked header
+        :return: list
+        """
+        references = (self.PAGE_WITH_PERIOD_DATA, self.PAGE_WITH_UNIT_DATA)
+        return [sheet for sheet, ws in enumerate(self._wb.worksheets)
+                if sheet not in references and self.get_header_index(ws)]
+
+    def get_references(self) -> dict:
+        """
+        Returns reference lists read from the workbook to be passed to parsers of other sheets
+        :return: dict (number of reference page -> (values, last row))
+        """
+        return {self.PAGE_WITH_PERIOD_DATA: (self.period_list, self.reference_ends.get(self.PAGE_WITH_PERIOD_DATA)),
+                self.PAGE_WITH_UNIT_DATA: (self.unit_list, self.reference_ends.get(self.PAGE_WITH_UNIT_DATA))}
+
+    def get_columns(self, col_nums: tuple) -> dict:
+        """
+        Fetches data rows of specified columns in one read up to the end of the sheet and returns them column by
+        column. The last row with a non-empty cell in these columns or in column C is stored as ending_row, trailing
+        empty rows are dropped while empty rows inside data are kept. In read-only mode fills of cells are kept too as
+        codes of distinct fills (cells themselves are not kept)
+        :param col_nums: tuple (numbers of columns to fetch)
+        :return: dict (column number -> tuple of values from STARTING_ROW to ending_row)
+        """
+        self._values = {}
+        self._fill_codes = {}
+        self._fills = []
+        self.ending_row = self.STARTING_ROW - 1
+        if not col_nums:
+            return self._values
+        min_col = min(col_nums + (self.NAME_COLUMN, ))
+        name = self.NAME_COLUMN - min_col
+        picker = itemgetter(*(col_num - min_col for col_num in col_nums))
+        rows = self._ws.iter_rows(min_row=self.STARTING_ROW,
+                                  min_col=min_col,
+                                  max_col=max(col_nums))
+        columns = [[] for _ in col_nums]
+        codes = [array('i') for _ in col_nums] if self.read_only else ()
+        fill_codes = {}  # id of fill -> its code, cells of read-only sheet share fill objects of the workbook
+        pending = []  # values and fill codes of empty rows after the last non-empty one, kept if data goes on
+        for row_num, row in enumerate(rows, self.STARTING_ROW):
+            cells = picker(row)
+            if len(col_nums) == 1:  # itemgetter with one index returns value itself, not a tuple
+                cells = (cells, )
+            values = [cell.value for cell in cells]
+            fills = []
+            if self.read_only:
+                for cell in cells:
+                    fill = cell.fill  # None for empty cells of read-only sheet
+                    if id(fill) not in fill_codes:
+                        fill_codes[id(fill)] = len(self._fills)
+                        self._fills.append(fill)  # fill is referenced, so its id is not reused
+                    fills.append(fill_codes[id(fill)])
+            pending.append((values, fills))
+            if is_empty(row[name].value) and all(is_empty(value) for value in values):
+                continue
+            for values, fills in pending:
+                for column, value in zip(columns, values):
+                    column.append(value)
+                for code, fill in zip(codes, fills):
+                    code.append(fill)
+            pending = []
+            self.ending_row = row_num
+        for i, col_num in enumerate(col_nums):
+            self._values[col_num] = tuple(columns[i])
+            columns[i] = None  # list is not needed anymore
+        self._fill_codes = dict(zip(col_nums, codes))
+        return self._values
+
     def get_values(self, sheet: int) -> tuple:
         """
-        Scans values from the first column of given Worksheet and returns them in tuple
+        Scans values from the first column of given Worksheet (empty cells are skipped) and returns them in tuple,
+        last non-empty row of the list is stored in reference_ends
         :param sheet: int
         :return: tuple
         """
@@ -367,77 +2158,372 @@ class XLSXParser:
             try:
                 self._wb.active = sheet
                 ws = self._wb.active
-                counter = 1
+                col = (row[0] for row in ws.iter_rows(min_col=1, max_col=1, values_only=True))
                 ans = []
-                while ws.cell(counter, 1).value is not None and ws.cell(counter, 1).value != '' and counter <= 1000:
-                    ans.append(ws.cell(counter, 1).value)
-                    counter += 1
-                self._wb.active = 0  # sets first page as active after all actions, just in case
+                end_row = 0
+                for row_num, value in enumerate(col, 1):
+                    if not is_empty(value):
+                        ans.append(value)
+                        end_row = row_num
+                self.reference_ends[sheet] = end_row
+                self._wb.active = self.sheet  # sets checked page as active after all actions, just in case
                 ans = tuple(OrderedDict.fromkeys(ans))  # delete all duplicates preserving order
                 # print(ans)
                 return ans
             except AttributeError:
-                print('page is not defined or does not exist')
+                logger.error('page %s is not defined or does not exist', sheet)
         else:
             raise NonePointer('Workbook is not defined')
 
-    def get_validator(self, page: int) -> DataValidation:
+    def get_validator(self, page: int):
         """
         returns data validator initialized with specified list(set)
         :param page: int (number of page with data that needs to be validated)
-        :return:
+        :return: DataValidation
         """
-        lt = self.get_values(page)  # this is needed just to find number of rows in the next line
-        end_row = get_end_row(lt, 1)
+        if page not in self.reference_ends:
+            self.get_values(page)  # this is needed just to find number of rows
+        end_row = self.reference_ends[page]
+        from openpyxl.worksheet.datavalidation import DataValidation
         self._wb.active = page
         # print("{}!$A$1:$A${}".format(quote_string(self._wb.active.title), end_row))
         dv = DataValidation(type='list', formula1="{}!$A$1:$A${}".format(quote_string(self._wb.active.title), end_row),
                             showDropDown=False)
-        self._wb.active = 0  # return to zero page
+        self._wb.active = self.sheet  # return to checked page
         return dv
 
-    def trans_period(self, col: tuple) -> tuple:
+    def trans_period(self, col: CategoryColumn) -> NumericColumn:
         """
-        transfers string in column 'Периодичность' to a number according to PERIOD_TRANSFER constant
-        :param col: tuple (a tuple of a column "Периодичность")
-        :return: tuple (with numbers according to PERIOD_TRANSFER
+        transfers string in column 'Периодичность' to a number according to PERIOD_TRANSFER constant (case, extra
+        whitespace and 'ё' are ignored), every distinct value is transferred once
+        :param col: CategoryColumn (column "Периодичность" after corrections, a tuple of values is accepted too)
+        :return: NumericColumn (with numbers according to PERIOD_TRANSFER)
         """
-        ans = []
-        for el in col:
-            ans.append(self.PERIOD_TRANSFER.get(el))
-        return tuple(ans)
+        if not isinstance(col, CategoryColumn):
+            col = CategoryColumn.from_values(col)
+        return NumericColumn.from_values(col.map(lambda el: self.PERIOD_KEYS.get(normalize_key(el))))
 
-    def assign_col(self, col: tuple, col_num: int):
+    def assign_col(self, col: tuple, col_num: int, cached: tuple = None):
         """
         assign values from the tuple to a specified column
         :param col: tuple (tuple with data to assign)
         :param col_num: int (number of column to assign)
+        :param cached: tuple (cached results of formulas from col, None for cells without result)
         :return:
         """
-        row_counter = self.STARTING_ROW
-        for el in col:
-            if el != '#ERR':
-                self._ws.cell(row_counter, col_num, el)
-            row_counter += 1
-
-    def form_price(self, periodicity: tuple, n: str, amount: str, tariff: str) -> tuple:
-        """returns formula tuple of 'Годовая стоимость' column"""
-        ans = []
-        row_counter = self.STARTING_ROW
-        for period in periodicity:
-            if period is not None and self._ws.cell(row_counter, column_index_from_string(n)).value is not None and \
-                    self._ws.cell(row_counter, column_index_from_string(amount)).value is not None and \
-                    self._ws.cell(row_counter, column_index_from_string(tariff)).value is not None:
-                ans.append('=' + n + str(row_counter) + '*' + str(period) + '*' + amount + str(row_counter) +
-                           '*' + tariff + str(row_counter) + '/1000')
-            else:
-                ans.append('#ERR')
-            row_counter += 1
-        return tuple(ans)
+        old_cached = self.get_cached_values(col_num) if cached is not None else None
+        for row_counter, el in enumerate(col, self.STARTING_ROW):
+            if el != '#ERR' and row_counter not in self.skip_rows:
+                if cached is None:
+                    self.set_value(row_counter, col_num, el)
+                else:
+                    i = row_counter - self.STARTING_ROW
+                    self.changes.add_value(row_counter, col_num, self.get_value(row_counter, col_num), el,
+                                           cached[i], old_cached[i] if i < len(old_cached) else None)
+
+    def get_cached_values(self, col_num: int) -> tuple:
+        """
+        Reads cached results of formulas of a column (as applications that do not calculate formulas see them)
+        :param col_num: int
+        :return: tuple
+        """
+        from openpyxl import load_workbook
+        wb = load_workbook(self.filepath, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[self.sheet].iter_rows(min_row=self.STARTING_ROW, max_row=self.ending_row,
+                                                       min_col=col_num, max_col=col_num, values_only=True)
+            return tuple(row[0] if row else None for row in rows)
+        finally:
+            wb.close()
+
+    def compute_price(self, periodicity: NumericColumn, n: NumericColumn, amount: NumericColumn,
+                      tariff: NumericColumn) -> NumericColumn:
+        """
+        Computes values of 'Годовая стоимость' column (n * period * amount * tariff / 1000) from normalized columns,
+        uses numpy if it is installed
+        :param periodicity: NumericColumn (numbers of periods from trans_period)
+        :param n: NumericColumn (normalized 'Раз' column)
+        :param amount: NumericColumn (normalized 'Объем' column)
+        :param tariff: NumericColumn (normalized 'Расценка' column)
+        :return: NumericColumn (invalid for rows where cost can not be computed or is not a number)
+        """
+        columns = (n, periodicity, amount, tariff)
+        np = get_numpy()
+        if np is None or not len(periodicity):
+            valid = bytearray(all(flags) for flags in zip(*(column.valid for column in columns)))
+            cost = array('d', (row[0] * row[1] * row[2] * row[3] / 1000 if is_valid else 0.0
+                               for is_valid, row in zip(valid, zip(*(column.values for column in columns)))))
+            for i, value in enumerate(cost):
+                if value != value:  # nan (from 'nan' in a cell or 'inf' * 0) is not a cost, as in numpy branch
+                    valid[i] = 0
+            return NumericColumn(cost, valid)
+        data = [np.frombuffer(column.values, dtype=float) for column in columns]
+        with np.errstate(invalid='ignore'):
+            cost = data[0] * data[1] * data[2] * data[3] / 1000
+        valid = np.logical_and.reduce([np.frombuffer(column.valid, dtype=bool) for column in columns]) & (cost == cost)
+        return NumericColumn(array('d', cost.tobytes()), bytearray(valid.tobytes()))
+
+    def form_price(self, periodicity: NumericColumn, columns: tuple, letters: tuple) -> tuple:
+        """
+        returns formula tuple of 'Годовая стоимость' column
+        :param periodicity: NumericColumn (numbers of periods from trans_period)
+        :param columns: tuple (of NumericColumn of 'Раз', 'Объем' and 'Расценка' columns)
+        :param letters: tuple (of letters of 'Раз', 'Объем' and 'Расценка' columns)
+        :return: tuple ('#ERR' for rows without formula, formula needs period and non-empty cells)
+        """
+        formula = '=' + letters[0] + '{0}*{1}*' + letters[1] + '{0}*' + letters[2] + '{0}/1000'
+        return tuple(formula.format(row, int(period) if is_integer(period) else period)
+                     if is_valid and all(present) else '#ERR'
+                     for row, period, is_valid, present in zip(range(self.STARTING_ROW, self.ending_row + 1),
+                                                               periodicity.values, periodicity.valid,
+                                                               zip(*(column.present for column in columns))))
+
+    def export_rows(self):
+        """
+        Generates cleaned rows of the checked sheet (see EXPORT_FIELDS) from compact columns kept by check_table, one
+        row for every data row of every section ('Годовая стоимость' and checked columns before it). Numbers are
+        normalized (None for cells without number), period and unit are corrected, cost is None where it can not be
+        computed, flags mark errors left in the row
+        :return: generator (of tuples)
+        """
+        title = self._ws.title
+        size = max(self.ending_row - self.STARTING_ROW + 1, 0)
+        empty = NumericColumn(array('d', bytes(8 * size)), bytearray(size))
+        no_errors = bytearray(size)
+        for section_num, section in enumerate(self.sections):
+            numbers = [self.numbers.get(section.get(header), empty) for header in self.NUM_SUBSECTIONS[:3]]
+            periods = self.corrected.get(section.get(self.PERIOD_SUBSECTIONS[0]))
+            units = self.corrected.get(section.get(self.UNIT_SUBSECTIONS[0]))
+            cost = self.costs.get(section.get(self.NUM_SUBSECTIONS[3]), empty)
+            masks = [self.errors[section[header]] for header in self.NUM_SUBSECTIONS if header in section]
+            number_errors = bytearray(map(any, zip(*masks))) if masks else no_errors
+            for row, n, amount, tariff, period, period_value, unit, price, number_error, period_error, unit_error in \
+                    zip(range(self.STARTING_ROW, self.ending_row + 1), *numbers,
+                        repeat(None) if periods is None else periods,
+                        empty if periods is None else self.trans_period(periods),
+                        repeat(None) if units is None else units, cost, number_errors,
+                        self.errors.get(section.get(self.PERIOD_SUBSECTIONS[0]), no_errors),
+                        self.errors.get(section.get(self.UNIT_SUBSECTIONS[0]), no_errors)):
+                yield (title, row, section_num, n, amount, tariff, period, period_value, unit,
+                       None if price is None else round_num(price), bool(number_error), bool(period_error),
+                       bool(unit_error))
+
+    def export(self, path: str = None) -> int:
+        """
+        Streams cleaned rows of the checked sheet (see export_rows) to CSV or parquet file, must be called after
+        check_table, returns number of written rows
+        :param path: str (export_path by default)
+        :return: int
+        """
+        count = write_export(self.export_rows(), self.export_path if path is None else path, self.export_format)
+        self.counters['exported'] += count
+        return count
+
+
+# Batch mode
+def collect_paths(pattern: str) -> list:
+    """
+    Returns sorted paths of .xlsx files from directory or matching glob pattern ('**' matches nested directories),
+    temporary files of Excel (~$) are skipped
+    :param pattern: str (path to directory or glob pattern)
+    :return: list
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.xlsx')
+    return sorted(path for path in glob.glob(pattern, recursive=True) if not os.path.basename(path).startswith('~$'))
+
+
+def get_batch_names(paths: list) -> list:
+    """
+    Returns paths of files relative to their common directory, so that files of nested directories with the same
+    name get different outputs in batch mode
+    :param paths: list
+    :return: list
+    """
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    return [os.path.relpath(os.path.abspath(path), base) for path in paths]
+
+
+def get_batch_target(directory: str, name: str, extension: str = None) -> str:
+    """
+    Returns path of output of batch mode for file with relative name, creates missing directories
+    :param directory: str (None if the output is not needed)
+    :param name: str (relative path from get_batch_names)
+    :param extension: str (new extension, extension of the name is kept if None)
+    :return: str or None
+    """
+    if directory is None:
+        return None
+    if extension is not None:
+        name = os.path.splitext(name)[0] + extension
+    target = os.path.join(directory, name)
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    return target
+
+
+def check_sheet(path: str, is_validator: bool, references: dict, options: dict, fingerprints: bool, export_dir: str,
+                sheet: int) -> tuple:
+    """
+    Checks one sheet of workbook in read-only mode without saving, used by XLSXParser.find_errors_in_sheets
+    :param path: str
+    :param is_validator: bool
+    :param references: dict (reference lists from XLSXParser.get_references)
+    :param options: dict (options of XLSXParser)
+    :param fingerprints: bool (return entry of cache)
+    :param export_dir: str (directory to export cleaned rows of the sheet to, file is named by number of the sheet)
+    :param sheet: int (number of sheet)
+    :return: tuple (ChangeSet, counters, timers, entry of cache or None)
+    """
+    export_path = None if export_dir is None else os.path.join(export_dir, str(sheet))
+    xl = XLSXParser(path, is_validator, prescan=True, dry_run=True, sheet=sheet, references=references,
+                    export_path=export_path, **options)
+    if xl.load_error is not None:
+        raise xl.load_error
+    if xl.cached_run is not None:  # the file was not changed since the last run, the sheet is not loaded
+        xl.replay_cached_run()
+        return xl.changes, xl.counters, xl.timers, xl.cached_run if fingerprints else None
+    try:
+        xl.check_table()
+        if export_path is not None:
+            with xl.timer('export'):
+                xl.export()
+        return xl.changes, xl.counters, xl.timers, xl.get_fingerprints() if fingerprints else None
+    finally:
+        xl._wb.close()
+
+
+def validate_file(path: str, is_validator: bool = True, output_path: str = None, report_path: str = None,
+                  export_path: str = None, all_sheets: bool = False, sheet_workers: int = None,
+                  **options) -> FileResult:
+    """
+    Checks and fixes one file, never raises - any failure is returned in result. This is the entry point for use of the
+    module as a library, nothing is read from stdin or printed (log records go to 'xlsx_parser' logger)
+    :param path: str
+    :param is_validator: bool
+    :param output_path: str (path to save fixed workbook to, by default the file is fixed in place)
+    :param report_path: str (path to write JSON report of changes to)
+    :param export_path: str (path to write cleaned rows to, CSV or parquet by extension)
+    :param all_sheets: bool (check all data sheets instead of the first one)
+    :param sheet_workers: int (number of processes checking sheets when all_sheets is set, number of CPUs by default)
+    :param options: other options of XLSXParser (prescan, dry_run, engine, price_mode, autocorrect, cache,
+    export_format)
+    :return: FileResult
+    """
+    try:
+        xl = XLSXParser(path, is_validator, report_path=report_path, output_path=output_path, export_path=export_path,
+                        **options)
+        if xl.load_error is not None:
+            return FileResult(path, False, xl.counters, repr(xl.load_error), xl.summary())
+        is_modified = xl.find_errors_in_sheets(sheet_workers) if all_sheets else xl.find_errors()
+        return FileResult(path, is_modified, xl.counters, None, xl.summary())
+    except Exception as e:  # one broken file should not stop the whole batch
+        return FileResult(path, False, {}, repr(e))
+
+
+def validate_batch(pattern: str, is_validator: bool = True, workers: int = None, output_dir: str = None,
+                   report_dir: str = None, export_dir: str = None, **options) -> list:
+    """
+    Checks and fixes all .xlsx files from directory or glob pattern in a pool of processes, outputs keep paths of
+    files relative to their common directory, missing directories are created
+    :param pattern: str (path to directory or glob pattern)
+    :param is_validator: bool
+    :param workers: int (number of processes, number of CPUs by default)
+    :param output_dir: str (directory to save fixed workbooks to, by default files are fixed in place)
+    :param report_dir: str (directory to write JSON reports of changes to, named as files with .json extension)
+    :param export_dir: str (directory to export cleaned rows to, named as files with extension of export_format)
+    :param options: other options passed to validate_file
+    :return: list (of FileResult in order of paths)
+    """
+    options.setdefault('sheet_workers', 1)  # files are already checked in parallel, their sheets are checked one by one
+    paths = collect_paths(pattern)
+    if not paths:
+        return []
+    names = get_batch_names(paths)
+    outputs = [get_batch_target(output_dir, name) for name in names]
+    reports = [get_batch_target(report_dir, name, '.json') for name in names]
+    extension = '.' + (options.get('export_format') or 'csv')
+    exports = [get_batch_target(export_dir, name, extension) for name in names]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(partial(validate_file, **options), paths, [is_validator] * len(paths), outputs, reports,
+                             exports))
+
+
+def format_result(result: FileResult) -> str:
+    """
+    Returns one line description of result for console
+    :param result: FileResult
+    :return: str
+    """
+    if result.error is not None:
+        return result.path + ': ошибка обработки ' + result.error
+    return result.path + ': ' + ('исправлен' if result.is_modified else 'без изменений') + ', ' + \
+        ', '.join(key + '=' + str(value) for key, value in result.counters.items())
+
+
+def main(argv: list = None) -> int:
+    """
+    Command line interface, returns exit code: 0 if all files were processed, 1 if any of them failed. If path is
+    not given it is asked interactively as before
+    :param argv: list (arguments, sys.argv[1:] by default)
+    :return: int
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='Проверка и исправление смет в .xlsx: числа, виды периодичности, '
+                                                 'единицы измерения и формулы годовой стоимости')
+    parser.add_argument('path', nargs='?', help='.xlsx файл, папка или шаблон (glob) для пакетной обработки')
+    parser.add_argument('--validators', action='store_true',
+                        help='добавить выпадающие списки к колонкам периодичности и единиц измерения')
+    parser.add_argument('-o', '--output', help='куда сохранить исправленный файл (папка при пакетной обработке), '
+                                               'по умолчанию файл исправляется на месте')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='только найти ошибки, не сохранять изменения')
+    parser.add_argument('--report', help='JSON отчет об изменениях (папка при пакетной обработке)')
+    parser.add_argument('--summary', help='файл для JSON сводки запуска')
+    parser.add_argument('--export', metavar='PATH', help='выгрузить очищенные строки в CSV или Parquet (по расширению '
+                                                         'файла), папка при пакетной обработке')
+    parser.add_argument('--export-format', choices=EXPORT_FORMATS,
+                        help='формат выгрузки, по умолчанию по расширению файла (csv для папки)')
+    parser.add_argument('--engine', choices=XLSXParser.ENGINES, default='openpyxl')
+    parser.add_argument('--price-mode', choices=XLSXParser.PRICE_MODES, default='formula')
+    parser.add_argument('--autocorrect', type=float, metavar='SIMILARITY',
+                        help='заменять ошибки периодичности и единиц измерения на близкое значение из списка')
+    parser.add_argument('--cache', nargs='?', const='', metavar='DIR',
+                        help='проверять только строки, измененные с прошлого запуска')
+    parser.add_argument('--prescan', action='store_true',
+                        help='сначала проверять файл в режиме чтения и загружать полностью, только если его нужно '
+                             'исправить (быстрее для файлов без ошибок)')
+    parser.add_argument('--all-sheets', action='store_true', help='проверить все листы со сметами, а не только первый')
+    parser.add_argument('--workers', type=int, help='число процессов при пакетной обработке или проверке листов')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='INFO')
+    args = parser.parse_args(argv)
+    path, is_validator = args.path, args.validators
+    if path is None:
+        path, is_validator = parse_input(input('Введите путь к .xlsx файлу (или папке/шаблону для пакетной обработки) '
+                                               'и через запятую напишите y/n нужно/не нужно добавлять валидатор: '))
+        path = path.strip()
+    enable_console(getattr(logging, args.log_level))
+    options = {'prescan': args.prescan, 'dry_run': args.dry_run, 'engine': args.engine,
+               'price_mode': args.price_mode, 'autocorrect': args.autocorrect,
+               'cache': None if args.cache is None else FingerprintCache(args.cache or None),
+               'all_sheets': args.all_sheets, 'export_format': args.export_format}
+    if os.path.isdir(path) or glob.has_magic(path):
+        results = validate_batch(path, is_validator, args.workers, args.output, args.report, args.export, **options)
+    else:
+        output, export = args.output, args.export
+        if output is not None and os.path.isdir(output):
+            output = os.path.join(output, os.path.basename(path))
+        if export is not None and os.path.isdir(export):
+            export = os.path.join(export, os.path.splitext(os.path.basename(path))[0] + '.' +
+                                  (args.export_format or 'csv'))
+        results = [validate_file(path, is_validator, output, args.report, export, sheet_workers=args.workers,
+                                 **options)]
+    for result in results:
+        print(format_result(result))
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump([result.summary for result in results], f, ensure_ascii=False, indent=2)
+    return 0 if all(result.error is None for result in results) else 1
 
 
-s = input('Введите путь к .xlsx файлу и через запятую напишите y/n нужно/не нужно добавлять валидатор: ')
-# print(s)
-path, is_validator = parse_input(s)
-xl = XLSXParser(path, is_validator)
-xl.find_errors()
+if __name__ == '__main__':
+    sys.exit(main())
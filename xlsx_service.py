@@ -0,0 +1,389 @@
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+from xlsx_parser import XLSXParser, enable_console, get_numpy, validate_file
+
+logger = logging.getLogger('xlsx_parser.service')
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+               408: 'Request Timeout', 411: 'Length Required', 413: 'Payload Too Large', 422: 'Unprocessable Entity',
+               500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
+
+
+class RequestError(Exception):
+    """
+    Raise when request can not be processed, status is HTTP status code of the response
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# Worker process functions
+def warm_up() -> int:
+    """
+    Imports openpyxl and numpy and creates default fills in a worker process, so that the first job does not pay for
+    it, returns pid of the worker
+    :return: int
+    """
+    from openpyxl.worksheet.datavalidation import DataValidation
+    DataValidation(type='list', formula1='$A$1:$A$1')  # loads openpyxl and descriptors of its objects
+    get_numpy()
+    for fill in XLSXParser.FILLS:
+        getattr(XLSXParser, fill)
+    return os.getpid()
+
+
+def run_job(data: bytes, path: str, output_path: str, options: dict) -> tuple:
+    """
+    Checks uploaded workbook (data) or workbook on disk (path) in a worker process, uploaded workbook is written to a
+    temporary directory and returned back if it was fixed. Workbook on disk is saved to a staged file next to its
+    target, the service moves it to the target only if the job is answered in time (see ValidationService.submit)
+    :param data: bytes (uploaded .xlsx file or None)
+    :param path: str (path to .xlsx file if data is None)
+    :param output_path: str (path to save fixed workbook on disk to, by default it is fixed in place)
+    :param options: dict (options of validate_file)
+    :return: tuple (FileResult, report of changes as dict or None, fixed workbook as bytes or None, path of staged
+    workbook or None if nothing has to be written)
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='xlsx_service_')
+    staged = None
+    is_staged = False
+    try:
+        if data is not None:
+            path = os.path.join(tmp_dir, 'workbook.xlsx')
+            with open(path, 'wb') as f:
+                f.write(data)
+        else:
+            target = path if output_path is None else output_path
+            fd, staged = tempfile.mkstemp(prefix='.' + os.path.basename(target) + '.', suffix='.xlsx',
+                                          dir=os.path.dirname(target))
+            os.close(fd)
+        report_path = os.path.join(tmp_dir, 'report.json')
+        result = validate_file(path, output_path=staged, report_path=report_path, **options)
+        report = None
+        if os.path.exists(report_path):
+            with open(report_path, encoding='utf-8') as f:
+                report = json.load(f)
+        workbook = None
+        if data is not None and result.is_modified and not options.get('dry_run'):
+            with open(path, 'rb') as f:
+                workbook = f.read()
+        if staged is not None:  # clean file checked in place needs no writing
+            is_staged = result.error is None and not options.get('dry_run') and (result.is_modified or
+                                                                                  output_path is not None)
+            if is_staged:
+                shutil.copymode(path, staged)
+            if result.summary is not None:
+                result.summary['output'] = target
+        return result, report, workbook, staged if is_staged else None
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if staged is not None and not is_staged:
+            os.remove(staged)
+
+
+def parse_options(query: dict) -> dict:
+    """
+    Returns options of validate_file from query parameters of request (or fields of JSON body), raises RequestError
+    on wrong values
+    :param query: dict
+    :return: dict
+    """
+    def flag(name):
+        return str(query.get(name, '')).lower() in TRUE_VALUES
+
+    options = {'is_validator': flag('validators'), 'dry_run': flag('dry_run'), 'all_sheets': flag('all_sheets'),
+               'sheet_workers': 1,  # requests are already checked in parallel
+               'engine': query.get('engine', 'openpyxl'), 'price_mode': query.get('price_mode', 'formula')}
+    if options['engine'] not in XLSXParser.ENGINES:
+        raise RequestError(400, 'unknown save engine ' + str(options['engine']))
+    if options['price_mode'] not in XLSXParser.PRICE_MODES:
+        raise RequestError(400, 'unknown price mode ' + str(options['price_mode']))
+    if query.get('autocorrect') not in (None, ''):
+        try:
+            options['autocorrect'] = float(query['autocorrect'])
+        except (TypeError, ValueError):
+            raise RequestError(400, 'autocorrect should be a number from 0 to 1')
+    return options
+
+
+class ValidationService:
+    """
+    Local HTTP service checking workbooks in a pool of pre-warmed processes:
+    POST /validate with .xlsx file in body (options in query: validators, dry_run, all_sheets, engine, price_mode,
+    autocorrect) returns JSON with result, report of changes and fixed workbook encoded in base64;
+    POST /validate with JSON body {"path": ..., "output": ..., options} checks file on disk, paths are relative to
+    root directory and can not lead outside of it (the request is rejected with 403 if root is not set);
+    GET /health returns number of workers and running jobs.
+    When all job slots are taken new requests are rejected with 503, jobs longer than timeout are answered with 504 and
+    their results are dropped: a workbook on disk is not changed by a job answered with 504
+    """
+
+    def __init__(self, workers: int = None, max_jobs: int = None, timeout: float = 60.0,
+                 max_body: int = 50 * 1024 * 1024, root: str = None, read_timeout: float = 10.0):
+        """
+        :param workers: int (number of worker processes, number of CPUs by default)
+        :param max_jobs: int (number of jobs running or waiting for a worker, twice the number of workers by default)
+        :param timeout: float (seconds to wait for result of a job)
+        :param max_body: int (maximum size of request body in bytes)
+        :param root: str (directory with workbooks which can be checked by path, checks by path are off if None)
+        :param read_timeout: float (seconds to wait for head and for body of request)
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_jobs = max_jobs or 2 * self.workers
+        self.timeout = timeout
+        self.max_body = max_body
+        self.root = None if root is None else os.path.realpath(root)
+        self.read_timeout = read_timeout
+        self.jobs = 0  # number of jobs running or waiting for a worker
+        self._pool = None
+        self._server = None
+
+    async def start(self):
+        """
+        Starts worker processes and waits until all of them are warmed up
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up)
+        pids = await asyncio.gather(*(loop.run_in_executor(self._pool, warm_up) for _ in range(self.workers)))
+        logger.info('%s worker processes are ready: %s', len(set(pids)), sorted(set(pids)))
+
+    async def close(self):
+        """
+        Stops server and worker processes
+        :return:
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8080, unix_path: str = None):
+        """
+        Starts workers and serves requests on TCP port or Unix socket until cancelled
+        :param host: str
+        :param port: int
+        :param unix_path: str (path of Unix socket, host and port are ignored if given)
+        :return:
+        """
+        await self.start()
+        if unix_path is not None:
+            self._server = await asyncio.start_unix_server(self.handle, path=unix_path)
+        else:
+            self._server = await asyncio.start_server(self.handle, host, port)
+        logger.info('listening on %s', unix_path or '{}:{}'.format(host, port))
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Reads one HTTP request from connection, answers it and closes connection
+        :param reader: asyncio.StreamReader
+        :param writer: asyncio.StreamWriter
+        :return:
+        """
+        try:
+            try:
+                method, target, headers, body = await self.read_request(reader)
+                status, payload = await self.dispatch(method, target, headers, body)
+            except RequestError as e:
+                status, payload = e.status, {'error': str(e)}
+            except Exception as e:  # answer anyway, service should not die on a broken request
+                logger.exception('request failed')
+                status, payload = 500, {'error': repr(e)}
+            content = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+            head = ['HTTP/1.1 {} {}'.format(status, STATUS_TEXT.get(status, '')),
+                    'Content-Type: application/json; charset=utf-8',
+                    'Content-Length: {}'.format(len(content)),
+                    'Connection: close']
+            if status == 503:
+                head.append('Retry-After: 1')
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + content)
+            await writer.drain()
+        except ConnectionError:  # client has gone
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader: asyncio.StreamReader) -> tuple:
+        """
+        Reads request line, headers and body of HTTP request
+        :param reader: asyncio.StreamReader
+        :return: tuple (method, target, headers with lowercase names, body)
+        """
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.read_timeout)
+        except asyncio.TimeoutError:
+            raise RequestError(408, 'request head was not received in {} seconds'.format(self.read_timeout))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            raise RequestError(400, 'bad request head')
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise RequestError(400, 'bad request line')
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        body = b''
+        if method == 'POST':
+            if 'content-length' not in headers:
+                raise RequestError(411, 'Content-Length is required')
+            try:
+                length = int(headers['content-length'])
+            except ValueError:
+                raise RequestError(400, 'Content-Length should be a number')
+            if length < 0:
+                raise RequestError(400, 'Content-Length should not be negative')
+            if length > self.max_body:
+                raise RequestError(413, 'request body is larger than {} bytes'.format(self.max_body))
+            try:
+                body = await asyncio.wait_for(reader.readexactly(length), self.read_timeout)
+            except asyncio.TimeoutError:
+                raise RequestError(408, 'request body was not received in {} seconds'.format(self.read_timeout))
+            except asyncio.IncompleteReadError:
+                raise RequestError(400, 'request body is incomplete')
+        return method, target, headers, body
+
+    async def dispatch(self, method: str, target: str, headers: dict, body: bytes) -> tuple:
+        """
+        Routes request and returns status and JSON payload of response
+        :param method: str
+        :param target: str
+        :param headers: dict
+        :param body: bytes
+        :return: tuple (status, payload)
+        """
+        url = urlsplit(target)
+        if url.path == '/health':
+            return 200, {'workers': self.workers, 'jobs': self.jobs, 'max_jobs': self.max_jobs}
+        if url.path != '/validate':
+            raise RequestError(404, 'unknown path ' + url.path)
+        if method != 'POST':
+            raise RequestError(405, 'use POST')
+        if headers.get('content-type', '').startswith('application/json'):
+            try:
+                query = json.loads(body.decode('utf-8'))
+            except ValueError:
+                raise RequestError(400, 'bad JSON body')
+            if not isinstance(query, dict) or not query.get('path'):
+                raise RequestError(400, 'path of workbook is required')
+            data, path = None, self.resolve(query['path'])
+            output_path = None if query.get('output') in (None, '') else self.resolve(query['output'])
+        else:
+            if not body:
+                raise RequestError(400, 'workbook is required in request body')
+            query = dict(parse_qsl(url.query))
+            data, path, output_path = body, None, None
+        result, report, workbook = await self.submit(data, path, output_path, parse_options(query))
+        payload = dict(result._asdict(), report=report,
+                       workbook=None if workbook is None else base64.b64encode(workbook).decode('ascii'))
+        if data is not None:
+            payload['path'] = None  # temporary file of the worker means nothing to client
+        return 422 if result.error is not None else 200, payload
+
+    def resolve(self, path: str) -> str:
+        """
+        Returns real path of file given in request relative to root directory, raises RequestError if checks by path
+        are off or the path leads outside of root (symbolic links are followed)
+        :param path: str
+        :return: str
+        """
+        if self.root is None:
+            raise RequestError(403, 'checks of files on disk are off, root directory is not set')
+        if not isinstance(path, str):
+            raise RequestError(400, 'path should be a string')
+        resolved = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath((self.root, resolved)) != self.root:
+            raise RequestError(403, 'path leads outside of root directory')
+        return resolved
+
+    async def submit(self, data: bytes, path: str, output_path: str, options: dict) -> tuple:
+        """
+        Runs job in the pool if there is a free slot, raises RequestError with 503 if there is not and with 504 if
+        job does not finish in time. Workbook staged by the job is moved to its target only when the job finishes in
+        time. Slot of timed out job is released only when the job really finishes, as its worker is busy until then,
+        and the workbook staged by it is removed
+        :param data: bytes
+        :param path: str
+        :param output_path: str
+        :param options: dict
+        :return: tuple (FileResult, report, workbook)
+        """
+        if self.jobs >= self.max_jobs:
+            raise RequestError(503, 'all {} job slots are busy'.format(self.max_jobs))
+        self.jobs += 1
+        future = asyncio.get_running_loop().run_in_executor(self._pool, run_job, data, path, output_path, options)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            future.add_done_callback(self.release)
+            raise RequestError(504, 'job did not finish in {} seconds'.format(self.timeout))
+        except BaseException:
+            future.add_done_callback(self.release)
+            raise
+        self.jobs -= 1
+        result, report, workbook, staged = result
+        if staged is not None:
+            os.replace(staged, path if output_path is None else output_path)
+        return result, report, workbook
+
+    def release(self, future: asyncio.Future):
+        """
+        Frees slot of a job which was answered before it finished and removes workbook staged by it, the client was
+        told that the job failed
+        :param future: asyncio.Future
+        :return:
+        """
+        self.jobs -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.error('job failed after its request was answered: %r', future.exception())
+        elif future.result()[3] is not None:
+            os.remove(future.result()[3])
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Локальный сервис проверки смет в .xlsx')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', metavar='PATH', help='слушать Unix сокет вместо TCP порта')
+    parser.add_argument('--workers', type=int, help='число процессов, по умолчанию число CPU')
+    parser.add_argument('--max-jobs', type=int, help='число одновременных задач, при превышении ответ 503')
+    parser.add_argument('--timeout', type=float, default=60.0, help='время ожидания задачи в секундах')
+    parser.add_argument('--max-body', type=int, default=50 * 1024 * 1024, help='наибольший размер запроса в байтах')
+    parser.add_argument('--root', metavar='DIR',
+                        help='папка с файлами, которые можно проверять по пути, без нее проверка по пути выключена')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='INFO')
+    args = parser.parse_args(argv)
+    enable_console(getattr(logging, args.log_level))
+    service = ValidationService(args.workers, args.max_jobs, args.timeout, args.max_body, args.root)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())